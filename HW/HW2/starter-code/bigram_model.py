@@ -1,5 +1,6 @@
 from multiprocessing import Pool
 import numpy as np
+import os
 import time
 from tagger_utils import *
 from collections import Counter, defaultdict
@@ -9,7 +10,7 @@ import copy
 """ Contains the part of speech tagger class. """
 
 
-def evaluate(data, model, method):
+def evaluate(data, model, method, processes=None):
     """Evaluates the POS model on some sentences and gold tags.
 
     This model can compute a few different accuracies:
@@ -21,38 +22,38 @@ def evaluate(data, model, method):
     or you can use it as is.
 
     As per the write-up, you may find it faster to use multiprocessing (code included).
+    processes is the number of worker processes, by default the number of CPU cores.
 
     """
-    processes = 4
+    processes = processes or os.cpu_count()
     sentences = data[0]
     tags = data[1]
     n = len(sentences)
-    k = n // processes
+    # Small chunks, longest documents first, so that idle workers keep taking work from the pool's queue
+    chunks = schedule_chunks([len(d) for d in sentences], processes)
     n_tokens = sum([len(d) for d in sentences])
     unk_n_tokens = sum([1 for s in sentences for w in s if w not in model.word2idx.keys()])
     predictions = {i: None for i in range(n)}
     probabilities = {i: None for i in range(n)}
 
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(infer_sentences, [model, sentences[i:i + k], i, method]))
-    ans = [r.get(timeout=None) for r in res]
-    predictions = dict()
-    for a in ans:
-        predictions.update(a)
-    print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
-
+    # The pool workers receive the documents once and attach to the model tables
+    with SharedModel(model) as shared_model, \
+            Pool(processes=min(processes, len(chunks)), initializer=init_worker,
+                 initargs=(shared_model, sentences)) as pool:
+        res = []
+        for chunk in chunks:
+            res.append(pool.apply_async(infer_documents, [chunk, method]))
+        ans = [r.get(timeout=None) for r in res]
+        predictions = dict()
+        for a in ans:
+            predictions.update(a)
+        predictions = dict(sorted(predictions.items()))  # chunks finish out of order
+        print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
+
+    # Scoring the whole corpus at once is a few array operations, no pool needed
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(compute_prob, [model, sentences[i:i + k], tags[i:i + k], i]))
-    ans = [r.get(timeout=None) for r in res]
-    probabilities = dict()
-    for a in ans:
-        probabilities.update(a)
+    probabilities = dict(enumerate(model.corpus_probability(Corpus.from_lists(sentences, tags)).tolist()))
     print(f"Probability Estimation Runtime: {(time.time() - start) / 60} minutes.")
 
     token_acc = sum(
@@ -84,9 +85,17 @@ def evaluate(data, model, method):
 
 
 class POSTagger():
+    # Training data and counts, only used while training
+    NOT_PICKLED = ('data', 'tag_ids', 'doc_offsets', 'word_ids', 'word_types', 'idx2word',
+                   'unigram_counts', 'bigram_counts', 'lexical_counts')
+
     def __init__(self):
         """Initializes the tagger model parameters and anything else necessary. """
         self.data = None
+        self.tag_ids = None
+        self.doc_offsets = None
+        self.word_ids = None
+        self.word_types = None
         self.unigram_probs = None
         self.bigram_probs = None
         self.trigram_probs = None
@@ -96,6 +105,32 @@ class POSTagger():
         self.idx2tag = {}
         self.word2idx = {}
         self.idx2word = {}
+        # log-space tables used by viterbi and greedy_decoding
+        self.log_unigram_probs = None
+        self.log_bigram_probs = None
+        self.log_lexical_probs = None
+
+    def __getstate__(self):
+        """
+        Pickles only what decoding needs (probability and log tables, vocabulary and tag maps),
+        e.g. when the model is sent to pool workers.
+        """
+        return {name: value for name, value in self.__dict__.items() if name not in self.NOT_PICKLED}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    def save(self, path, training=None):
+        """Saves what decoding needs (see __getstate__) as a versioned .npz artifact, with what it was trained on."""
+        save_artifact(path, self.__getstate__(), training)
+
+    @classmethod
+    def load(cls, path, training=None):
+        """Loads a model written by save, see load_artifact for the checks done."""
+        model = cls()
+        model.__setstate__(load_artifact(path, training))
+        return model
 
     def get_unigrams(self):
         """
@@ -104,10 +139,7 @@ class POSTagger():
                 unigrams[tag] = Prob(tag)
         """
         N = len(self.all_tags)  # number of tags
-        self.unigram_counts = np.zeros(N)
-        for tags in self.data[1]:
-            for tag in tags:
-                self.unigram_counts[self.tag2idx[tag]] += 1
+        self.unigram_counts = ngram_counts(self.tag_ids, self.doc_offsets, 1, N)
         total_counts = np.sum(self.unigram_counts)
         # Laplace smoothing
         m, V = 1, N
@@ -120,12 +152,7 @@ class POSTagger():
              such that bigrams[index[tag1], index[tag2]] = Prob(tag2|tag1).
         """
         N = len(self.all_tags)
-        self.bigram_counts = np.zeros((N, N))
-        for tags in self.data[1]:
-            for i in range(len(tags) - 1):
-                idx_tag1 = self.tag2idx[tags[i]]
-                idx_tag2 = self.tag2idx[tags[i + 1]]
-                self.bigram_counts[idx_tag1, idx_tag2] += 1
+        self.bigram_counts = ngram_counts(self.tag_ids, self.doc_offsets, 2, N)
 
         # 使用拉普拉斯平滑（Add-k smoothing）
         if SMOOTHING == LAPLACE:
@@ -141,19 +168,8 @@ class POSTagger():
                 lambda_1, lambda_2 = LAMBDAS
 
             # 使用线性插值结合 unigram 和 bigram 概率
-            self.bigram_probs = np.zeros((N, N))
-            for i in range(N):
-                for j in range(N):
-                    bigram_count = self.bigram_counts[i, j]
-                    unigram_count = self.unigram_counts[j]
-                    total_bigrams = self.bigram_counts.sum(axis=1)[i]
-                    total_unigrams = self.unigram_counts.sum()
-
-                    prob_bigram = (bigram_count + EPSILON) / (total_bigrams + EPSILON)
-                    prob_unigram = (unigram_count + EPSILON) / (total_unigrams + EPSILON)
-
-                    # 线性插值
-                    self.bigram_probs[i, j] = lambda_1 * prob_bigram + lambda_2 * prob_unigram
+            self.bigram_probs = interpolate_ngram_probs(
+                [self.bigram_counts, self.unigram_counts], [lambda_1, lambda_2])
 
     def get_emissions(self, threshold=None):
         """
@@ -161,29 +177,21 @@ class POSTagger():
         Tip. Map each tag to an integer and each word in the vocabulary to an integer.
              Then create a numpy array such that lexical[index(tag), index(word)] = Prob(word|tag)
         """
-        word_counts = defaultdict(int)
-        for words in self.data[0]:
-            for word in words:
-                word_counts[word] += 1
+        word_ids, word_types = self.word_ids, self.word_types
+        word_counts = np.bincount(word_ids, minlength=len(word_types))
+        known = word_counts >= threshold
 
         # Fill the word2idx - no threshold
         self.word2idx = {'<UNK>': 0}
-        self.idx2word = {0: '<UNK>'}
-        idx = 1
-        for word, count in word_counts.items():
-            if count >= threshold:
-                self.word2idx[word] = idx
-                self.idx2word[idx] = word
-                idx += 1
+        self.word2idx.update({word: idx for idx, word in enumerate(word_types[known], start=1)})
+        self.idx2word = {idx: word for word, idx in self.word2idx.items()}
 
         N_tag = len(self.all_tags)
         N_word = len(self.word2idx)
-        self.lexical_counts = np.zeros((N_tag, N_word))
-        for words, tags in zip(self.data[0], self.data[1]):
-            for word, tag in zip(words, tags):
-                idx_tag = self.tag2idx[tag]
-                idx_word = self.word2idx.get(word, 0)  # Map rare words to '<UNK>'
-                self.lexical_counts[idx_tag, idx_word] += 1
+        token_idx = np.where(known, np.cumsum(known), 0)[word_ids]  # Map rare words to '<UNK>'
+        self.lexical_counts = np.bincount(
+            self.tag_ids * N_word + token_idx, minlength=N_tag * N_word
+        ).reshape(N_tag, N_word).astype(float)
 
         if SMOOTHING == LAPLACE:
             # Laplace smoothing
@@ -198,19 +206,13 @@ class POSTagger():
                 lambda_1, lambda_2 = LAMBDAS
 
             # Calculating word-level unigram probabilities
-            total_words = sum(word_counts.values())
-            word_unigram_probs = np.zeros(N_word)
-            for word, idx in self.word2idx.items():
-                word_unigram_probs[idx] = (word_counts[word] + EPSILON) / (total_words + EPSILON)
+            # word_unigram_probs[0] belongs to '<UNK>', which is never counted
+            total_words = word_counts.sum()
+            word_unigram_probs = (np.concatenate([[0], word_counts[known]]) + EPSILON) / (total_words + EPSILON)
 
             # Linearly interpolate emission probabilities
-            self.lexical_probs = np.zeros((N_tag, N_word))
-            for i in range(N_tag):
-                for j in range(N_word):
-                    prob_emission = (self.lexical_counts[i, j] + EPSILON) / (
-                                self.lexical_counts.sum(axis=1)[i] + EPSILON)
-                    prob_word_unigram = word_unigram_probs[j]
-                    self.lexical_probs[i, j] = lambda_1 * prob_emission + lambda_2 * prob_word_unigram
+            prob_emission = (self.lexical_counts + EPSILON) / (self.lexical_counts.sum(axis=1, keepdims=True) + EPSILON)
+            self.lexical_probs = lambda_1 * prob_emission + lambda_2 * word_unigram_probs
 
 
     def train(self, data, emission_threshold=None):
@@ -222,7 +224,8 @@ class POSTagger():
 
         """
         self.data = data
-        self.all_tags = list(set([t for tag in data[1] for t in tag]))
+        # Encode the tags and words once, all counts are computed from the flat arrays
+        self.all_tags, self.tag_ids, self.doc_offsets, self.word_ids, self.word_types = encode_training_data(data)
         self.tag2idx = {self.all_tags[i]: i for i in range(len(self.all_tags))}
         self.idx2tag = {v: k for k, v in self.tag2idx.items()}
 
@@ -230,6 +233,14 @@ class POSTagger():
         self.get_unigrams()
         self.get_bigrams()
         self.get_emissions(emission_threshold)
+        self.get_log_probs()
+
+    def get_log_probs(self):
+        """Computes the log tables used by viterbi and greedy_decoding, zero probabilities become -inf."""
+        with np.errstate(divide='ignore'):
+            self.log_unigram_probs = np.log(self.unigram_probs)
+            self.log_bigram_probs = np.log(self.bigram_probs)
+            self.log_lexical_probs = np.log(self.lexical_probs)
 
     def sequence_probability(self, sequence, tags):
         """Computes the probability of a tagged sequence given the emission/transition probabilities."""
@@ -266,6 +277,30 @@ class POSTagger():
         return sequence_log_prob
 
 
+    def corpus_probability(self, corpus):
+        """
+        Log probabilities of all documents of a tagged Corpus, sequence_probability of each of them.
+        The per token probabilities are gathered with fancy indexing and their logs summed per document
+        with np.add.reduceat.
+
+        Returns:
+            np.ndarray: log probability of every document
+        """
+        tags = np.array([self.tag2idx[tag] for tag in corpus.tag_vocab], dtype=np.int64)[corpus.tag_ids]
+        unk_idx = self.word2idx.get('<UNK>', 0)
+        words = np.array([self.word2idx.get(word, unk_idx) for word in corpus.word_vocab], dtype=np.int64)[corpus.word_ids]
+        prev = np.roll(tags, 1)  # the values at the start of a document are not used
+        if SMOOTHING == LAPLACE:
+            transition_probs = self.bigram_probs[prev, tags]
+        elif SMOOTHING == INTERPOLATION:
+            lambda_1, lambda_2 = (0.6, 0.4) if LAMBDAS is None else LAMBDAS
+            transition_probs = lambda_1 * self.bigram_probs[prev, tags] + lambda_2 * self.unigram_probs[tags]
+        first = ragged_arange(np.diff(corpus.offsets)) == 0
+        transition_probs = np.where(first, self.unigram_probs[tags], transition_probs)
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(transition_probs) + np.log(self.lexical_probs[tags, words])
+        return document_sums(log_probs, corpus.offsets)
+
     def inference(self, method, sequence):
         """Tags a sequence with part of speech tags."""
         if method == 'viterbi':
@@ -278,32 +313,17 @@ class POSTagger():
             raise ValueError("Unknown decoding method.")
 
     def greedy_decoding(self, sequence):
-        """Tags a sequence with part of speech tags using greedy decoding."""
-        tag_pred = []
-        N_tag = len(self.all_tags)
+        """Tags a sequence with part of speech tags using greedy decoding.
+
+        Tags are kept as ids, every word is one argmax of transition row plus emission column.
+        """
+        tag_ids = []
+        unk_idx = self.word2idx.get('<UNK>', 0)
         for i, word in enumerate(sequence):
-            idx_word = self.word2idx.get(word, self.word2idx.get('<UNK>', 0))
-            tag_cur = None
-            prob_cur = float('-inf')
-            if i == 0:
-                for idx in range(N_tag):
-                    emission_prob = self.lexical_probs[idx, idx_word]
-                    unigram_prob = self.unigram_probs[idx]
-                    total_log_prob = np.log(emission_prob) + np.log(unigram_prob) if emission_prob > 0 and unigram_prob > 0 else float('-inf')
-                    if total_log_prob > prob_cur:
-                        tag_cur = self.idx2tag[idx]
-                        prob_cur = total_log_prob
-            else:
-                prev_tag_idx = self.tag2idx[tag_pred[-1]]
-                for idx in range(N_tag):
-                    emission_prob = self.lexical_probs[idx, idx_word]
-                    transition_prob = self.bigram_probs[prev_tag_idx, idx]
-                    total_log_prob = np.log(emission_prob) + np.log(transition_prob) if emission_prob > 0 and transition_prob > 0 else float('-inf')
-                    if total_log_prob > prob_cur:
-                        tag_cur = self.idx2tag[idx]
-                        prob_cur = total_log_prob
-            tag_pred.append(tag_cur)
-        return tag_pred
+            log_transitions = self.log_unigram_probs if i == 0 else self.log_bigram_probs[tag_ids[-1]]
+            scores = self.log_lexical_probs[:, self.word2idx.get(word, unk_idx)] + log_transitions
+            tag_ids.append(scores.argmax())
+        return [self.idx2tag[idx] for idx in tag_ids]
 
     def beam_search(self, sequence, k):
         """Tags a sequence with part of speech tags using beam search."""
@@ -340,32 +360,28 @@ class POSTagger():
             return [self.idx2tag[0]] * N_word
 
     def viterbi(self, sequence):
-        """Tags a sequence with part of speech tags using Viterbi algorithm."""
+        """Tags a sequence with part of speech tags using Viterbi algorithm.
+
+        Every step is one max/argmax over pi[t - 1][:, None] + log A + log B[:, w] on the log tables.
+        """
         N_word = len(sequence)
         N_tag = len(self.all_tags)
-        pi = np.full((N_word, N_tag), float('-inf'))
         backpointer = np.zeros((N_word, N_tag), dtype=int)
+        unk_idx = self.word2idx.get('<UNK>', 0)
+        word_ids = [self.word2idx.get(word, unk_idx) for word in sequence]
+        log_emissions = self.log_lexical_probs[:, word_ids].T
 
-        word_idx = self.word2idx.get(sequence[0], self.word2idx.get('<UNK>', 0))
-        for i in range(N_tag):
-            if self.unigram_probs[i] > 0 and self.lexical_probs[i, word_idx] > 0:
-                pi[0, i] = np.log(self.unigram_probs[i]) + np.log(self.lexical_probs[i, word_idx])
-            backpointer[0, i] = 0
-
+        pi = self.log_unigram_probs + log_emissions[0]
+        scores = np.empty((N_tag, N_tag))
+        tag_range = np.arange(N_tag)
         for t in range(1, N_word):
-            word_idx = self.word2idx.get(sequence[t], self.word2idx.get('<UNK>', 0))
-            for j in range(N_tag):
-                max_prob = float('-inf')
-                best_prev_tag = 0
-                for i in range(N_tag):
-                    prob = pi[t - 1, i] + np.log(self.bigram_probs[i, j]) + np.log(self.lexical_probs[j, word_idx]) if self.bigram_probs[i, j] > 0 and self.lexical_probs[j, word_idx] > 0 else float('-inf')
-                    if prob > max_prob:
-                        max_prob = prob
-                        best_prev_tag = i
-                pi[t, j] = max_prob
-                backpointer[t, j] = best_prev_tag
-
-        best_last_tag = np.argmax(pi[N_word - 1, :])
+            # scores[i, j] = pi[i] + log q(j | i) + log e(x_t | j)
+            np.add(pi[:, None], self.log_bigram_probs, out=scores)
+            scores += log_emissions[t]
+            backpointer[t] = scores.argmax(axis=0)
+            pi = scores[backpointer[t], tag_range]
+
+        best_last_tag = pi.argmax()
         tag_pred_idx = [best_last_tag]
 
         for t in range(N_word - 1, 0, -1):
@@ -376,30 +392,28 @@ class POSTagger():
         return [self.idx2tag[idx] for idx in tag_pred_idx]
 
 
-
 if __name__ == "__main__":
-    pos_tagger = POSTagger()
-    train_data = load_data("data/train_x.csv", "data/train_y.csv")
     dev_data = load_data("data/dev_x.csv", "data/dev_y.csv")
-    test_x = load_data("data/test_x.csv")
 
     emission_threshold = 2
-    pos_tagger.train(train_data, emission_threshold)
+    # Start from the model saved by an earlier run with the same settings and training data, delete the file to retrain
+    model_file = os.path.splitext(os.path.basename(__file__))[0] + '.npz'
+    train_files = ["data/train_x.csv", "data/train_y.csv"]
+    training = training_info(train_files, emission_threshold)
+    try:
+        pos_tagger = POSTagger.load(model_file, training)
+    except (OSError, ValueError):
+        pos_tagger = POSTagger()
+        train_data = Corpus.load(*train_files)
+        pos_tagger.train(train_data, emission_threshold)
+        pos_tagger.save(model_file, training)
 
     # evaluate model by dev_data
     method = 'beam'
     evaluate(dev_data, pos_tagger, method)
 
-    # test prediction
-    test_y = []
-    for sentence in test_x:
-        pred_tags = pos_tagger.inference(method, sentence)  # 可以选择 'viterbi'、'beam'、'greedy'
-        test_y.append(pred_tags)
-
-    flat_predictions = [tag for sent_tags in test_y for tag in sent_tags]
-    ids = list(range(len(flat_predictions)))
-
-    # write the result to the 'test_y.csv' file
-    df = pd.DataFrame({'id': ids, 'tag': flat_predictions})
-    df.to_csv('test_y.csv', index=False)
+    # test prediction, each document is tagged and written to 'test_y.csv' as it is read
+    test_x = iter_data("data/test_x.csv")
+    test_y = (pos_tagger.inference(method, sentence) for sentence in test_x)  # 可以选择 'viterbi'、'beam'、'greedy'
+    write_predictions('test_y.csv', test_y)
     print("Test predictions saved to test_y.csv.")
@@ -1,5 +1,6 @@
 from multiprocessing import Pool
 import numpy as np
+import os
 import time
 from tagger_utils import *
 from collections import Counter, defaultdict
@@ -14,7 +15,7 @@ from sklearn.feature_extraction.text import CountVectorizer
 """ Contains the part of speech tagger class. """
 
 
-def evaluate(data, model, method):
+def evaluate(data, model, method, processes=None):
     """Evaluates the POS model on some sentences and gold tags.
 
     This model can compute a few different accuracies:
@@ -26,39 +27,45 @@ def evaluate(data, model, method):
     or you can use it as is.
 
     As per the write-up, you may find it faster to use multiprocessing (code included).
+    processes is the number of worker processes, by default the number of CPU cores.
 
     """
-    processes = 4
+    processes = processes or os.cpu_count()
     sentences = data[0]
     tags = data[1]
     n = len(sentences)
-    k = n // processes
+    # Small chunks, longest documents first, so that idle workers keep taking work from the pool's queue
+    chunks = schedule_chunks([len(d) for d in sentences], processes)
     n_tokens = sum([len(d) for d in sentences])
     unk_n_tokens = sum([1 for s in sentences for w in s if w not in model.word2idx.keys()])
     predictions = {i: None for i in range(n)}
     probabilities = {i: None for i in range(n)}
 
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(infer_sentences, [model, sentences[i:i + k], i, method]))
-    ans = [r.get(timeout=None) for r in res]
-    predictions = dict()
-    for a in ans:
-        predictions.update(a)
-    print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
-
-    start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(compute_prob, [model, sentences[i:i + k], tags[i:i + k], i]))
-    ans = [r.get(timeout=None) for r in res]
-    probabilities = dict()
-    for a in ans:
-        probabilities.update(a)
-    print(f"Probability Estimation Runtime: {(time.time() - start) / 60} minutes.")
+    # One pool serves both phases, its workers receive the documents once and attach to the model tables
+    with SharedModel(model) as shared_model, \
+            Pool(processes=min(processes, len(chunks)), initializer=init_worker,
+                 initargs=(shared_model, sentences, tags)) as pool:
+        res = []
+        for chunk in chunks:
+            res.append(pool.apply_async(infer_documents, [chunk, method]))
+        ans = [r.get(timeout=None) for r in res]
+        predictions = dict()
+        for a in ans:
+            predictions.update(a)
+        predictions = dict(sorted(predictions.items()))  # chunks finish out of order
+        print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
+
+        start = time.time()
+        res = []
+        for chunk in chunks:
+            res.append(pool.apply_async(compute_prob_documents, [chunk]))
+        ans = [r.get(timeout=None) for r in res]
+        probabilities = dict()
+        for a in ans:
+            probabilities.update(a)
+        probabilities = dict(sorted(probabilities.items()))  # chunks finish out of order
+        print(f"Probability Estimation Runtime: {(time.time() - start) / 60} minutes.")
 
     token_acc = sum(
         [1 for i in range(n) for j in range(len(sentences[i])) if tags[i][j] == predictions[i][j]]) / n_tokens
@@ -1,5 +1,6 @@
 from multiprocessing import Pool
 import numpy as np
+import os
 import time
 from tagger_utils import *
 from collections import Counter, defaultdict
@@ -14,7 +15,7 @@ from sklearn.feature_extraction.text import CountVectorizer
 """ Contains the part of speech tagger class. """
 
 
-def evaluate(data, model, method):
+def evaluate(data, model, method, processes=None):
     """Evaluates the POS model on some sentences and gold tags.
 
     This model can compute a few different accuracies:
@@ -26,38 +27,38 @@ def evaluate(data, model, method):
     or you can use it as is.
 
     As per the write-up, you may find it faster to use multiprocessing (code included).
+    processes is the number of worker processes, by default the number of CPU cores.
 
     """
-    processes = 4
+    processes = processes or os.cpu_count()
     sentences = data[0]
     tags = data[1]
     n = len(sentences)
-    k = n // processes
+    # Small chunks, longest documents first, so that idle workers keep taking work from the pool's queue
+    chunks = schedule_chunks([len(d) for d in sentences], processes)
     n_tokens = sum([len(d) for d in sentences])
     unk_n_tokens = sum([1 for s in sentences for w in s if w not in model.word2idx.keys()])
     predictions = {i: None for i in range(n)}
     probabilities = {i: None for i in range(n)}
 
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(infer_sentences, [model, sentences[i:i + k], i, method]))
-    ans = [r.get(timeout=None) for r in res]
-    predictions = dict()
-    for a in ans:
-        predictions.update(a)
-    print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
-
+    # The pool workers receive the documents once and attach to the model tables
+    with SharedModel(model) as shared_model, \
+            Pool(processes=min(processes, len(chunks)), initializer=init_worker,
+                 initargs=(shared_model, sentences)) as pool:
+        res = []
+        for chunk in chunks:
+            res.append(pool.apply_async(infer_documents, [chunk, method]))
+        ans = [r.get(timeout=None) for r in res]
+        predictions = dict()
+        for a in ans:
+            predictions.update(a)
+        predictions = dict(sorted(predictions.items()))  # chunks finish out of order
+        print(f"Inference Runtime: {(time.time() - start) / 60} minutes.")
+
+    # Scoring the whole corpus at once is a few array operations, no pool needed
     start = time.time()
-    pool = Pool(processes=processes)
-    res = []
-    for i in range(0, n, k):
-        res.append(pool.apply_async(compute_prob, [model, sentences[i:i + k], tags[i:i + k], i]))
-    ans = [r.get(timeout=None) for r in res]
-    probabilities = dict()
-    for a in ans:
-        probabilities.update(a)
+    probabilities = dict(enumerate(model.corpus_probability(Corpus.from_lists(sentences, tags)).tolist()))
     print(f"Probability Estimation Runtime: {(time.time() - start) / 60} minutes.")
 
     token_acc = sum(
@@ -89,9 +90,19 @@ def evaluate(data, model, method):
 
 
 class POSTagger():
+    # Training data, counts and the probabilities the decoding tables are computed from, and per-process buffers
+    NOT_PICKLED = ('data', 'tag_ids', 'doc_offsets', 'word_ids', 'word_types', 'idx2word',
+                   'unigram_counts', 'bigram_counts', 'trigram_counts', 'lexical_counts',
+                   'unigram_probs', 'bigram_probs', 'trigram_probs', 'lexical_probs',
+                   'suffix_tag_probs', 'unknown_tag_probs', 'viterbi_workspace', 'word_cache')
+
     def __init__(self):
         """Initializes the tagger model parameters and anything else necessary."""
         self.data = None
+        self.tag_ids = None
+        self.doc_offsets = None
+        self.word_ids = None
+        self.word_types = None
         self.unigram_probs = None
         self.bigram_probs = None
         self.trigram_probs = None
@@ -102,8 +113,45 @@ class POSTagger():
         self.word2idx = {}
         self.idx2word = {}
         # unknown words parameter
-        self.suffix_tag_probs = {}
+        self.suffix_tag_probs = None
         self.unknown_tag_probs = None
+        # log-space tables used by the decoders
+        self.log_unigram_probs = None
+        self.log_bigram_probs = None
+        self.log_trigram_probs = None
+        self.log_lexical_probs = None
+        self.log_suffix_tag_probs = None
+        self.log_unknown_tag_probs = None
+        # tag dictionary, candidate tags of known words and of the suffix trie nodes
+        self.tag_dict = []
+        self.suffix_tag_dict = []
+        self.unknown_tag_dict = None
+        # buffers reused by viterbi
+        self.viterbi_workspace = None
+        # resolved emissions and candidates of recently seen words, see lookup_word
+        self.word_cache = None
+
+    def __getstate__(self):
+        """
+        Pickles only what decoding needs (log tables, vocabulary, tag maps, suffix model and tag dictionary),
+        e.g. when the model is sent to pool workers.
+        """
+        return {name: value for name, value in self.__dict__.items() if name not in self.NOT_PICKLED}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.__dict__.update(state)
+
+    def save(self, path, training=None):
+        """Saves what decoding needs (see __getstate__) as a versioned .npz artifact, with what it was trained on."""
+        save_artifact(path, self.__getstate__(), training)
+
+    @classmethod
+    def load(cls, path, training=None):
+        """Loads a model written by save, see load_artifact for the checks done."""
+        model = cls()
+        model.__setstate__(load_artifact(path, training))
+        return model
 
     def get_unigrams(self):
         """
@@ -111,10 +159,7 @@ class POSTagger():
         Tip. Map each tag to an integer and store the unigrams in a numpy array.
         """
         N = len(self.all_tags)
-        self.unigram_counts = np.zeros(N)
-        for tags in self.data[1]:
-            for tag in tags:
-                self.unigram_counts[self.tag2idx[tag]] += 1
+        self.unigram_counts = ngram_counts(self.tag_ids, self.doc_offsets, 1, N)
         total_counts = np.sum(self.unigram_counts)
         m, V = 1, N
         self.unigram_probs = (self.unigram_counts + m) / (total_counts + m * V)
@@ -124,12 +169,7 @@ class POSTagger():
         Computes bigrams with smoothing.
         """
         N = len(self.all_tags)
-        self.bigram_counts = np.zeros((N, N))
-        for tags in self.data[1]:
-            for i in range(len(tags) - 1):
-                idx_tag1 = self.tag2idx[tags[i]]
-                idx_tag2 = self.tag2idx[tags[i + 1]]
-                self.bigram_counts[idx_tag1, idx_tag2] += 1
+        self.bigram_counts = ngram_counts(self.tag_ids, self.doc_offsets, 2, N)
 
         # Add-k smoothing
         if SMOOTHING == LAPLACE:
@@ -144,29 +184,15 @@ class POSTagger():
             else:
                 lambda_1, lambda_2 = LAMBDAS
 
-            self.bigram_probs = np.zeros((N, N))
-            for i in range(N):
-                for j in range(N):
-                    bigram_count = self.bigram_counts[i, j]
-                    unigram_count = self.unigram_counts[j]
-                    total_bigrams = self.bigram_counts.sum(axis=1)[i]
-                    total_unigrams = self.unigram_counts.sum()
-                    prob_bigram = (bigram_count + EPSILON) / (total_bigrams + EPSILON)
-                    prob_unigram = (unigram_count + EPSILON) / (total_unigrams + EPSILON)
-                    self.bigram_probs[i, j] = lambda_1 * prob_bigram + lambda_2 * prob_unigram
+            self.bigram_probs = interpolate_ngram_probs(
+                [self.bigram_counts, self.unigram_counts], [lambda_1, lambda_2])
 
     def get_trigrams(self):
         """
         Computes trigrams with smoothing.
         """
         N = len(self.all_tags)
-        self.trigram_counts = np.zeros((N, N, N))
-        for tags in self.data[1]:
-            for i in range(len(tags) - 2):
-                idx_tag1 = self.tag2idx[tags[i]]
-                idx_tag2 = self.tag2idx[tags[i + 1]]
-                idx_tag3 = self.tag2idx[tags[i + 2]]
-                self.trigram_counts[idx_tag1, idx_tag2, idx_tag3] += 1
+        self.trigram_counts = ngram_counts(self.tag_ids, self.doc_offsets, 3, N)
 
         # Add-k smoothing
         if SMOOTHING == LAPLACE:
@@ -182,65 +208,38 @@ class POSTagger():
             else:
                 lambda_1, lambda_2, lambda_3 = LAMBDAS
 
-            self.trigram_probs = np.zeros((N, N, N))
-            for i in range(N):
-                for j in range(N):
-                    for k in range(N):
-                        trigram_count = self.trigram_counts[i, j, k]
-                        bigram_count = self.bigram_counts[j, k]
-                        unigram_count = self.unigram_counts[k]
-                        total_trigrams = self.trigram_counts.sum(axis=2)[i, j]
-                        total_bigrams = self.bigram_counts.sum(axis=1)[j]
-                        total_unigrams = self.unigram_counts.sum()
-
-                        prob_trigram = (trigram_count + EPSILON) / (total_trigrams + EPSILON)
-                        prob_bigram = (bigram_count + EPSILON) / (total_bigrams + EPSILON)
-                        prob_unigram = (unigram_count + EPSILON) / (total_unigrams + EPSILON)
-
-                        self.trigram_probs[i, j, k] = (
-                            lambda_1 * prob_trigram
-                            + lambda_2 * prob_bigram
-                            + lambda_3 * prob_unigram
-                        )
+            self.trigram_probs = interpolate_ngram_probs(
+                [self.trigram_counts, self.bigram_counts, self.unigram_counts], [lambda_1, lambda_2, lambda_3])
 
     def get_emissions(self, threshold=None):
         """
         Computes emission probabilities with TnT-style suffix handling for unknown words.
         """
-        word_counts = defaultdict(int)
-        for words in self.data[0]:
-            for word in words:
-                word_counts[word] += 1
+        word_ids, word_types = self.word_ids, self.word_types
+        word_counts = np.bincount(word_ids, minlength=len(word_types))
+        known = word_counts >= UNK_C
 
         # Initialize word2idx and idx2word for known words
         self.word2idx = {'<UNK>': 0}
-        self.idx2word = {0: '<UNK>'}
-        idx = 1
-        for word, count in word_counts.items():
-            if count >= UNK_C:
-                self.word2idx[word] = idx
-                self.idx2word[idx] = word
-                idx += 1
+        self.word2idx.update({word: idx for idx, word in enumerate(word_types[known], start=1)})
+        self.idx2word = {idx: word for word, idx in self.word2idx.items()}
 
         N_tag = len(self.all_tags)
         N_word = len(self.word2idx)
-        self.lexical_counts = np.zeros((N_tag, N_word))
-
-        # Initialize suffix_tag_counts for unknown word
-        suffix_tag_counts = defaultdict(lambda: np.zeros(N_tag))
-
-        for words, tags in zip(self.data[0], self.data[1]):
-            for word, tag in zip(words, tags):
-                idx_tag = self.tag2idx[tag]
-                if word in self.word2idx:
-                    idx_word = self.word2idx[word]
-                    self.lexical_counts[idx_tag, idx_word] += 1
-                else:
-                    # 对低频词，收集其后缀和标签的统计信息
-                    for m in range(1, UNK_M + 1):
-                        if len(word) >= m:
-                            suffix = word[-m:]
-                            suffix_tag_counts[suffix][idx_tag] += 1
+        # Vocabulary index of every token, 0 for low-frequency words
+        token_idx = np.where(known, np.cumsum(known), 0)[word_ids]
+        is_known = token_idx > 0
+        self.lexical_counts = np.bincount(
+            self.tag_ids[is_known] * N_word + token_idx[is_known], minlength=N_tag * N_word
+        ).reshape(N_tag, N_word).astype(float)
+
+        # Collect suffix statistics for low-frequency words, grouped by word type
+        rare_type_idx = np.cumsum(~known) - 1
+        rare_tag_counts = np.bincount(
+            rare_type_idx[word_ids[~is_known]] * N_tag + self.tag_ids[~is_known],
+            minlength=(~known).sum() * N_tag
+        ).reshape(-1, N_tag)
+        suffixes, suffix_counts = suffix_tag_counts(word_types[~known], rare_tag_counts, UNK_M)
 
         # compute the emission prob
         if SMOOTHING == LAPLACE:
@@ -253,35 +252,27 @@ class POSTagger():
             else:
                 lambda_1, lambda_2 = LAMBDAS
 
-            total_words = sum(word_counts.values())
-            word_unigram_probs = np.zeros(N_word)
-            for word, idx in self.word2idx.items():
-                word_unigram_probs[idx] = (word_counts[word] + EPSILON) / (total_words + EPSILON)
-
-            self.lexical_probs = np.zeros((N_tag, N_word))
-            for i in range(N_tag):
-                for j in range(N_word):
-                    prob_emission = (self.lexical_counts[i, j] + EPSILON) / (
-                        self.lexical_counts.sum(axis=1)[i] + EPSILON)
-                    prob_word_unigram = word_unigram_probs[j]
-                    self.lexical_probs[i, j] = lambda_1 * prob_emission + lambda_2 * prob_word_unigram
-
-        # convert suffix_tag_counts to prob
-        self.suffix_tag_probs = {}
-        for suffix, counts in suffix_tag_counts.items():
-            total_counts = counts.sum()
-            if total_counts > 0:
-                self.suffix_tag_probs[suffix] = counts / total_counts
-            else:
-                self.suffix_tag_probs[suffix] = np.ones(N_tag) / N_tag
+            # word_unigram_probs[0] belongs to '<UNK>', which is never counted
+            total_words = word_counts.sum()
+            word_unigram_probs = (np.concatenate([[0], word_counts[known]]) + EPSILON) / (total_words + EPSILON)
+
+            prob_emission = (self.lexical_counts + EPSILON) / (self.lexical_counts.sum(axis=1, keepdims=True) + EPSILON)
+            self.lexical_probs = lambda_1 * prob_emission + lambda_2 * word_unigram_probs
+
+        # convert suffix_tag_counts to prob, every suffix has been seen at least once
+        self.suffix_tag_probs = SuffixTrie.from_suffixes(suffixes, suffix_counts / suffix_counts.sum(axis=1, keepdims=True))
 
         # 对于未知词，默认使用均匀分布
         self.unknown_tag_probs = np.ones(N_tag) / N_tag
 
     def train(self, data, emission_threshold=None):
         """Trains the model by computing transition and emission probabilities."""
+        # Words resolved and buffers sized by an earlier training would not match the new tables
+        self.word_cache = None
+        self.viterbi_workspace = None
         self.data = data
-        self.all_tags = list(set([t for tag in data[1] for t in tag]))
+        # Encode the tags and words once, all counts are computed from the flat arrays
+        self.all_tags, self.tag_ids, self.doc_offsets, self.word_ids, self.word_types = encode_training_data(data)
         self.tag2idx = {self.all_tags[i]: i for i in range(len(self.all_tags))}
         self.idx2tag = {v: k for k, v in self.tag2idx.items()}
 
@@ -290,42 +281,150 @@ class POSTagger():
         self.get_bigrams()
         self.get_trigrams()
         self.get_emissions(emission_threshold)
+        self.get_log_probs()
+        self.get_tag_dict()
+
+    def get_log_probs(self):
+        """
+        Computes the log tables used at inference time.
+        Probabilities are clamped to MIN_PROB so that no decoder has to take a logarithm.
+        """
+        self.log_unigram_probs = np.log(np.maximum(self.unigram_probs, MIN_PROB))
+        self.log_bigram_probs = np.log(np.maximum(self.bigram_probs, MIN_PROB))
+        self.log_trigram_probs = np.log(np.maximum(self.trigram_probs, MIN_PROB))
+        self.log_lexical_probs = np.log(np.maximum(self.lexical_probs, MIN_PROB))
+        self.log_suffix_tag_probs = self.suffix_tag_probs.with_values(np.log(np.maximum(self.suffix_tag_probs.values, MIN_PROB)))
+        self.log_unknown_tag_probs = np.log(np.maximum(self.unknown_tag_probs, MIN_PROB))
+
+    def get_tag_dict(self):
+        """
+        Computes the tag dictionary: the tags each known word was seen with, and for unknown words
+        the tags seen with their suffix. Decoders only score these candidate tags.
+        """
+        all_tag_ids = np.arange(len(self.all_tags))
+        seen = self.lexical_counts.T != 0
+        seen[0] = True  # '<UNK>' is never counted
+        self.tag_dict = TagDict.from_mask(seen)
+        self.suffix_tag_dict = TagDict.from_mask(self.suffix_tag_probs.values != 0)
+        self.unknown_tag_dict = all_tag_ids
 
     def sequence_probability(self, sequence, tags):
         sequence_log_prob = 0.0
-        N_tag = len(self.all_tags)
-        min_prob = 1e-10
         for i, word in enumerate(sequence):
             idx_tag = self.tag2idx[tags[i]]
-
-            # 获取词的索引
-            idx_word = self.word2idx.get(word, -1)
-            if idx_word == -1:
-                # unknown word
-                suffix_probs = self.unknown_tag_probs
-                for m in range(1, UNK_M + 1):
-                    if len(word) >= m:
-                        suffix = word[-m:]
-                        if suffix in self.suffix_tag_probs:
-                            suffix_probs = self.suffix_tag_probs[suffix]
-                            break  # 使用最长匹配的后缀
-                emission_prob = max(suffix_probs[idx_tag], min_prob)
-            else:
-                emission_prob = max(self.lexical_probs[idx_tag, idx_word], min_prob)
+            emission_log_prob = self.get_log_emission_probs(word)[idx_tag]
 
             if i == 0:
-                transition_prob = max(self.unigram_probs[idx_tag], min_prob)
+                transition_log_prob = self.log_unigram_probs[idx_tag]
             elif i == 1:
                 idx_pre_tag = self.tag2idx[tags[i - 1]]
-                transition_prob = max(self.bigram_probs[idx_pre_tag, idx_tag], min_prob)
+                transition_log_prob = self.log_bigram_probs[idx_pre_tag, idx_tag]
             else:
                 idx_pre_tag1 = self.tag2idx[tags[i - 2]]
                 idx_pre_tag2 = self.tag2idx[tags[i - 1]]
-                transition_prob = max(self.trigram_probs[idx_pre_tag1, idx_pre_tag2, idx_tag], min_prob)
+                transition_log_prob = self.log_trigram_probs[idx_pre_tag1, idx_pre_tag2, idx_tag]
 
-            sequence_log_prob += np.log(transition_prob) + np.log(emission_prob)
+            sequence_log_prob += transition_log_prob + emission_log_prob
         return sequence_log_prob
 
+    def corpus_probability(self, corpus):
+        """
+        Log probabilities of all documents of a tagged Corpus, sequence_probability of each of them.
+        Emissions are looked up once per word type, then every token's log probabilities are gathered
+        with fancy indexing and summed per document with np.add.reduceat.
+
+        Returns:
+            np.ndarray: log probability of every document
+        """
+        tags = np.array([self.tag2idx[tag] for tag in corpus.tag_vocab], dtype=np.int64)[corpus.tag_ids]
+        type_log_emissions = np.stack([self.get_log_emission_probs(word) for word in corpus.word_vocab])
+        # previous tags, the values at the start of a document are not used
+        prev1, prev2 = np.roll(tags, 1), np.roll(tags, 2)
+        positions = ragged_arange(np.diff(corpus.offsets))
+        log_transitions = np.select([positions == 0, positions == 1],
+                                    [self.log_unigram_probs[tags], self.log_bigram_probs[prev1, tags]],
+                                    self.log_trigram_probs[prev2, prev1, tags])
+        return document_sums(log_transitions + type_log_emissions[corpus.word_ids, tags], corpus.offsets)
+
+    def resolve_word(self, word):
+        """
+        Returns the log emission probabilities of word for every tag and the ids of the tags the decoders
+        consider for it, in increasing order. Unknown words use the longest of their suffixes in the suffix model.
+        """
+        idx_word = self.word2idx.get(word, -1)
+        return self.word_entry(idx_word, self.log_suffix_tag_probs.longest_suffix(word) if idx_word == -1 else -1)
+
+    def resolve_words(self, words):
+        """resolve_word for several words, the suffixes of all unknown ones are matched in one trie walk."""
+        idx_words = [self.word2idx.get(word, -1) for word in words]
+        unknown = [word for word, idx_word in zip(words, idx_words) if idx_word == -1]
+        nodes = iter(self.log_suffix_tag_probs.longest_suffixes(unknown).tolist())
+        return [self.word_entry(idx_word, next(nodes) if idx_word == -1 else -1) for idx_word in idx_words]
+
+    def word_entry(self, idx_word, node):
+        """The result of resolve_word for the known word idx_word, or else for suffix trie node node (-1: none)."""
+        if idx_word != -1:
+            log_emission_probs, tag_candidates = self.log_lexical_probs[:, idx_word], self.tag_dict[idx_word]
+        elif node != -1:
+            log_emission_probs, tag_candidates = self.log_suffix_tag_probs.values[node], self.suffix_tag_dict[node]
+        else:
+            log_emission_probs, tag_candidates = self.log_unknown_tag_probs, self.unknown_tag_dict
+        if not TAG_DICT:
+            tag_candidates = np.arange(len(self.all_tags))
+        return log_emission_probs, tag_candidates
+
+    def lookup_word(self, word):
+        """resolve_word through an LRU cache of EMISSION_CACHE_SIZE words that lives as long as the process."""
+        if self.word_cache is None:
+            self.word_cache = LRUCache(EMISSION_CACHE_SIZE)
+        return self.word_cache.get(word, self.resolve_word)
+
+    def lookup_words(self, words):
+        """lookup_word for several words, the ones missing from the cache are resolved together by resolve_words."""
+        if self.word_cache is None:
+            self.word_cache = LRUCache(EMISSION_CACHE_SIZE)
+        return self.word_cache.get_many(words, self.resolve_words)
+
+    def get_log_emission_probs(self, word):
+        """Returns the log emission probabilities of word for every tag, using the suffix model for unknown words."""
+        return self.lookup_word(word)[0]
+
+    def get_tag_candidates(self, word):
+        """Returns the ids of the tags the decoders consider for word, in increasing order."""
+        return self.lookup_word(word)[1]
+
+    def get_batch_candidates(self, sequences):
+        """
+        Candidates and emissions of the words of several documents, for the batch decoders.
+
+        Documents are sorted longest first and their tokens numbered by time step, so token_offsets[t] + b is
+        word t of the b-th document in that order and the documents still running at step t are the first
+        token_offsets[t + 1] - token_offsets[t] ones.
+
+        Returns:
+            order: the document order, lengths: the sorted lengths, token_offsets, prev: the token of the
+            previous word of every token (itself for first words), candidates: the candidate tags of all
+            tokens concatenated, n_candidates: their number per token, log_emissions: like candidates.
+        """
+        order = np.argsort([-len(sequence) for sequence in sequences], kind='stable')
+        lengths = np.array([len(sequences[b]) for b in order])
+        n_running = np.searchsorted(-lengths, -np.arange(lengths[0]))
+        token_offsets = np.concatenate([[0], np.cumsum(n_running)])
+        words = [sequences[order[b]][t] for t in range(lengths[0]) for b in range(n_running[t])]
+        # Candidates and emissions are looked up once per word type, then gathered for every token
+        types = {}
+        type_ids = np.array([types.setdefault(word, len(types)) for word in words])
+        resolved = self.lookup_words(list(types))
+        type_log_emissions = [log_emission_probs[tag_ids] for log_emission_probs, tag_ids in resolved]
+        type_sizes = np.array([len(tag_ids) for _, tag_ids in resolved])
+        n_candidates = type_sizes[type_ids]
+        index = np.repeat((np.cumsum(type_sizes) - type_sizes)[type_ids], n_candidates) + ragged_arange(n_candidates)
+        candidates = np.concatenate([tag_ids for _, tag_ids in resolved])[index]
+        log_emissions = np.concatenate(type_log_emissions)[index]
+        steps = np.repeat(np.arange(lengths[0]), n_running)
+        prev = np.arange(len(words)) - np.where(steps > 0, n_running[steps - 1], 0)
+        return order, lengths, token_offsets, prev, candidates, n_candidates, log_emissions
+
     def inference(self, method, sequence):
         """Tags a sequence with part of speech tags."""
         if method == 'viterbi':
@@ -337,242 +436,273 @@ class POSTagger():
         else:
             raise ValueError("Unknown decoding method.")
 
+    def inference_batch(self, method, sequences, batch_size=64):
+        """
+        Tags several sequences. For viterbi and greedy, documents are sorted by length and decoded batch_size at
+        a time by viterbi_batch and greedy_batch, beam search decodes one document at a time. So does viterbi
+        without TAG_DICT, where every word has all tags as candidates and the dense steps of viterbi are faster
+        than the gathers of viterbi_batch.
+        """
+        if method == 'viterbi' and TAG_DICT:
+            decode_batch = self.viterbi_batch
+        elif method == 'greedy':
+            decode_batch = self.greedy_batch
+        else:
+            return [self.inference(method, sequence) for sequence in sequences]
+        tag_preds = [None] * len(sequences)
+        order = np.argsort([len(sequence) for sequence in sequences], kind='stable')
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            for i, tag_pred in zip(batch, decode_batch([sequences[i] for i in batch])):
+                tag_preds[i] = tag_pred
+        return tag_preds
+
     def greedy_decoding(self, sequence):
-        """Tags a sequence with part of speech tags using greedy decoding."""
-        tag_pred = []
-        N_tag = len(self.all_tags)
-        min_prob = 1e-10  # 防止取对数时出现 log(0)
-        for i, word in enumerate(sequence):
-            idx_word = self.word2idx.get(word, -1)
-            if idx_word == -1:
-                # 处理未知词
-                suffix_probs = self.unknown_tag_probs
-                for m in range(1, UNK_M + 1):
-                    if len(word) >= m:
-                        suffix = word[-m:]
-                        if suffix in self.suffix_tag_probs:
-                            suffix_probs = self.suffix_tag_probs[suffix]
-                            break  # 使用最长匹配的后缀
-                emission_probs = suffix_probs
+        """Tags a sequence with part of speech tags using greedy decoding.
+
+        Tags are kept as ids, every word is one argmax over its candidates of transition row plus emissions.
+        """
+        tag_ids = []
+        for i, (log_emission_probs, tag_candidates) in enumerate(self.lookup_words(sequence)):
+            if i == 0:
+                log_transitions = self.log_unigram_probs
+            elif i == 1:
+                log_transitions = self.log_bigram_probs[tag_ids[-1]]
             else:
-                emission_probs = self.lexical_probs[:, idx_word]
-
-            prob_cur = float('-inf')
-            tag_cur = None
-            for idx in range(N_tag):
-                emission_prob = max(emission_probs[idx], min_prob)
-                if i == 0:
-                    transition_prob = max(self.unigram_probs[idx], min_prob)
-                elif i == 1:
-                    prev_tag_idx = self.tag2idx[tag_pred[-1]]
-                    transition_prob = max(self.bigram_probs[prev_tag_idx, idx], min_prob)
-                else:
-                    prev_tag_idx1 = self.tag2idx[tag_pred[-2]]
-                    prev_tag_idx2 = self.tag2idx[tag_pred[-1]]
-                    transition_prob = max(self.trigram_probs[prev_tag_idx1, prev_tag_idx2, idx], min_prob)
-
-                total_log_prob = np.log(emission_prob) + np.log(transition_prob)
-                if total_log_prob > prob_cur:
-                    prob_cur = total_log_prob
-                    tag_cur = self.idx2tag[idx]
-            tag_pred.append(tag_cur)
-        return tag_pred
+                log_transitions = self.log_trigram_probs[tag_ids[-2], tag_ids[-1]]
+            scores = log_emission_probs[tag_candidates] + log_transitions[tag_candidates]
+            tag_ids.append(tag_candidates[scores.argmax()])
+        return [self.idx2tag[idx] for idx in tag_ids]
+
+    def greedy_batch(self, sequences):
+        """
+        Greedy decoding of several documents at once, see get_batch_candidates for the layout. A time step of
+        the whole batch is one gather of the transitions and one segment_argmax over the candidates.
+        Gives the same tags as greedy_decoding.
+        """
+        order, lengths, token_offsets, prev, candidates, n_candidates, log_emissions = self.get_batch_candidates(sequences)
+        candidate_bounds = np.concatenate([[0], np.cumsum(n_candidates)])
+        # token of every candidate and of its two previous words
+        token = np.repeat(np.arange(len(n_candidates)), n_candidates)
+        last, last2 = prev[token], prev[prev[token]]
+        positions = ragged_arange(n_candidates)
+        token_tags = np.zeros(len(n_candidates), dtype=np.int64)
+        for t in range(lengths[0]):
+            tokens = slice(token_offsets[t], token_offsets[t + 1])
+            step = slice(candidate_bounds[tokens.start], candidate_bounds[tokens.stop])
+            if t == 0:
+                log_transitions = self.log_unigram_probs[candidates[step]]
+            elif t == 1:
+                log_transitions = self.log_bigram_probs[token_tags[last[step]], candidates[step]]
+            else:
+                log_transitions = self.log_trigram_probs[token_tags[last2[step]], token_tags[last[step]], candidates[step]]
+            _, best = segment_argmax(log_emissions[step] + log_transitions, n_candidates[tokens], positions[step])
+            token_tags[tokens] = candidates[candidate_bounds[:-1][tokens] + best]
+
+        tag_preds = [None] * len(sequences)
+        for b, sequence_idx in enumerate(order):
+            tag_preds[sequence_idx] = [self.idx2tag[idx] for idx in token_tags[token_offsets[:lengths[b]] + b].tolist()]
+        return tag_preds
 
     def beam_search(self, sequence, k):
-        """Tags a sequence with part of speech tags using beam search."""
-        N_word = len(sequence)
-        N_tag = len(self.all_tags)
-        min_prob = 1e-10  # 防止取对数时出现 log(0)
+        """Tags a sequence with part of speech tags using beam search.
 
-        # Initialize beam
-        beam = []
-        idx_word = self.word2idx.get(sequence[0], -1)
-        if idx_word == -1:
-            # Unknown word handling
-            suffix_probs = self.unknown_tag_probs
-            for m in range(1, UNK_M + 1):
-                if len(sequence[0]) >= m:
-                    suffix = sequence[0][-m:]
-                    if suffix in self.suffix_tag_probs:
-                        suffix_probs = self.suffix_tag_probs[suffix]
-                        break
-            emission_probs = suffix_probs
-        else:
-            emission_probs = self.lexical_probs[:, idx_word]
+        Every step scores all (beam entry, candidate tag) pairs in one array operation and keeps the
+        best k with np.argpartition. Paths are only rebuilt at the end, from per-step backpointers.
+        """
+        N_word = len(sequence)
+        # beam_tags[t, i] is the tag of beam entry i at word t, parents[t, i] its beam entry at word t - 1
+        beam_tags = np.zeros((N_word, k), dtype=int)
+        parents = np.zeros((N_word, k), dtype=int)
 
-        for i in range(N_tag):
-            emission_prob = max(emission_probs[i], min_prob)
-            transition_prob = max(self.unigram_probs[i], min_prob)
-            total_log_prob = np.log(emission_prob) + np.log(transition_prob)
-            path = [i]
-            heapq.heappush(beam, (-total_log_prob, path))
+        resolved = self.lookup_words(sequence)
 
-        beam = heapq.nsmallest(k, beam)
+        # Initialize beam
+        log_emission_probs, tag_candidates = resolved[0]
+        scores = self.log_unigram_probs[tag_candidates] + log_emission_probs[tag_candidates]
+        best = top_k(scores, k)
+        beam_scores = scores[best]
+        beam_tags[0, :len(best)] = tag_candidates[best]
+        prev_tags, cur_tags = None, beam_tags[0, :len(best)]
 
         for t in range(1, N_word):
-            candidates = []
-            idx_word = self.word2idx.get(sequence[t], -1)
-            if idx_word == -1:
-                # Unknown word handling
-                suffix_probs = self.unknown_tag_probs
-                for m in range(1, UNK_M + 1):
-                    if len(sequence[t]) >= m:
-                        suffix = sequence[t][-m:]
-                        if suffix in self.suffix_tag_probs:
-                            suffix_probs = self.suffix_tag_probs[suffix]
-                            break
-                emission_probs = suffix_probs
+            log_emission_probs, tag_candidates = resolved[t]
+            log_emission_probs = log_emission_probs[tag_candidates]
+            if t == 1:
+                log_transitions = self.log_bigram_probs[cur_tags[:, None], tag_candidates]
             else:
-                emission_probs = self.lexical_probs[:, idx_word]
-
-            for neg_log_prob, path in beam:
-                for j in range(N_tag):
-                    emission_prob = max(emission_probs[j], min_prob)
-                    if emission_prob == 0:
-                        continue
-                    if t == 1:
-                        prev_tag_idx = path[-1]
-                        transition_prob = max(self.bigram_probs[prev_tag_idx, j], min_prob)
-                    else:
-                        prev_tag_idx1 = path[-2]
-                        prev_tag_idx2 = path[-1]
-                        transition_prob = max(self.trigram_probs[prev_tag_idx1, prev_tag_idx2, j], min_prob)
-                    if transition_prob == 0:
-                        continue
-                    total_log_prob = -neg_log_prob + np.log(transition_prob) + np.log(emission_prob)
-                    heapq.heappush(candidates, (-total_log_prob, path + [j]))
-            beam = heapq.nsmallest(k, candidates)
-
-        if beam:
-            _, tag_pred_idx = min(beam)
-            tag_pred = [self.idx2tag[idx] for idx in tag_pred_idx]
-            return tag_pred
-        else:
-            return [self.idx2tag[np.argmax(self.unigram_probs)]] * N_word
+                log_transitions = self.log_trigram_probs[prev_tags[:, None], cur_tags[:, None], tag_candidates]
+            scores = (beam_scores[:, None] + log_transitions + log_emission_probs).ravel()
+            best = top_k(scores, k)
+            beam_parents, beam_candidates = np.divmod(best, len(tag_candidates))
+            parents[t, :len(best)] = beam_parents
+            beam_tags[t, :len(best)] = tag_candidates[beam_candidates]
+            beam_scores = scores[best]
+            prev_tags, cur_tags = cur_tags[beam_parents], beam_tags[t, :len(best)]
+
+        # Backtracking from the best final entry
+        tags_idx = [0] * N_word
+        entry = beam_scores.argmax()
+        for t in range(N_word - 1, -1, -1):
+            tags_idx[t] = beam_tags[t, entry]
+            entry = parents[t, entry]
+        tag_pred = [self.idx2tag[idx] for idx in tags_idx]
+        return tag_pred
 
     def viterbi(self, sequence):
         N_word = len(sequence)
-        N_tag = len(self.all_tags)
-        min_prob = 1e-10  # 防止取对数时出现 log(0)
-
-        # Initialize
-        pi = np.full((N_word, N_tag, N_tag), float('-inf'))
-        backpointer = np.zeros((N_word, N_tag, N_tag), dtype=int)
+        resolved = self.lookup_words(sequence)
+        candidates = [tag_ids for _, tag_ids in resolved]
+        log_emissions = [log_emission_probs[tag_ids] for log_emission_probs, tag_ids in resolved]
+        n_candidates = [len(tag_ids) for tag_ids in candidates]
 
         # first word
-        idx_word = self.word2idx.get(sequence[0], -1)
-        if idx_word == -1:
-            # Unknown word handling
-            suffix_probs = self.unknown_tag_probs
-            for m in range(1, UNK_M + 1):
-                if len(sequence[0]) >= m:
-                    suffix = sequence[0][-m:]
-                    if suffix in self.suffix_tag_probs:
-                        suffix_probs = self.suffix_tag_probs[suffix]
-                        break
-            emission_probs = suffix_probs
-        else:
-            emission_probs = self.lexical_probs[:, idx_word]
-
-        for u in range(N_tag):
-            emission_prob = max(emission_probs[u], min_prob)
-            pi[0, 0, u] = np.log(self.unigram_probs[u]) + np.log(emission_prob)
-            backpointer[0, 0, u] = 0
+        pi_first = self.log_unigram_probs[candidates[0]] + log_emissions[0]
+        if N_word == 1:
+            return [self.idx2tag[candidates[0][np.argmax(pi_first)]]]
+
+        # Only the previous and current pi slices are kept, pi[a, b] is the best log probability of
+        # a path whose last two tags are candidates[t - 1][a], candidates[t][b].
+        # The backpointers of step t are stored at backpointer_offsets[t - 2] of a flat buffer.
+        if self.viterbi_workspace is None:
+            self.viterbi_workspace = ViterbiWorkspace(len(self.all_tags))
+        workspace = self.viterbi_workspace
+        backpointer_offsets = np.cumsum([0] + [n_candidates[t - 1] * n_candidates[t] for t in range(2, N_word)])
+        workspace.reserve(backpointer_offsets[-1])
 
         # second word
-        if N_word > 1:
-            idx_word = self.word2idx.get(sequence[1], -1)
-            if idx_word == -1:
-                # Unknown word handling
-                suffix_probs = self.unknown_tag_probs
-                for m in range(1, UNK_M + 1):
-                    if len(sequence[1]) >= m:
-                        suffix = sequence[1][-m:]
-                        if suffix in self.suffix_tag_probs:
-                            suffix_probs = self.suffix_tag_probs[suffix]
-                            break
-                emission_probs = suffix_probs
-            else:
-                emission_probs = self.lexical_probs[:, idx_word]
-
-            for u in range(N_tag):
-                for v in range(N_tag):
-                    emission_prob = max(emission_probs[v], min_prob)
-                    transition_prob = max(self.bigram_probs[u, v], min_prob)
-                    pi[1, u, v] = pi[0, 0, u] + np.log(transition_prob) + np.log(emission_prob)
-                    backpointer[1, u, v] = 0
+        log_transitions = self.log_bigram_probs
+        if TAG_DICT:
+            log_transitions = log_transitions[candidates[0][:, None], candidates[1]]
+        pi = workspace.pi(1, (n_candidates[0], n_candidates[1]))
+        np.add(pi_first[:, None], log_transitions, out=pi)
+        pi += log_emissions[1]
 
         for t in range(2, N_word):
-            idx_word = self.word2idx.get(sequence[t], -1)
-            if idx_word == -1:
-                # Unknown word handling
-                suffix_probs = self.unknown_tag_probs
-                for m in range(1, UNK_M + 1):
-                    if len(sequence[t]) >= m:
-                        suffix = sequence[t][-m:]
-                        if suffix in self.suffix_tag_probs:
-                            suffix_probs = self.suffix_tag_probs[suffix]
-                            break
-                emission_probs = suffix_probs
-            else:
-                emission_probs = self.lexical_probs[:, idx_word]
-
-            for u in range(N_tag):
-                for v in range(N_tag):
-                    emission_prob = max(emission_probs[v], min_prob)
-                    max_prob = float('-inf')
-                    best_w = 0
-                    for w in range(N_tag):
-                        transition_prob = max(self.trigram_probs[w, u, v], min_prob)
-                        prob = pi[t - 1, w, u] + np.log(transition_prob) + np.log(emission_prob)
-                        if prob > max_prob:
-                            max_prob = prob
-                            best_w = w
-                    pi[t, u, v] = max_prob
-                    backpointer[t, u, v] = best_w
-
-        max_prob = float('-inf')
-        best_u, best_v = 0, 0
-        for u in range(N_tag):
-            for v in range(N_tag):
-                if pi[N_word - 1, u, v] > max_prob:
-                    max_prob = pi[N_word - 1, u, v]
-                    best_u, best_v = u, v
-
-        tags_idx = [0] * N_word
-        tags_idx[N_word - 1] = best_v
-        tags_idx[N_word - 2] = best_u
+            log_transitions = self.log_trigram_probs
+            if TAG_DICT:
+                log_transitions = log_transitions[candidates[t - 2][:, None, None], candidates[t - 1][:, None], candidates[t]]
+            # scores[w, u, v] = pi[w, u] + log q(v | w, u) + log e(x_t | v)
+            scores = workspace.scores((n_candidates[t - 2], n_candidates[t - 1], n_candidates[t]))
+            np.add(pi[:, :, None], log_transitions, out=scores)
+            scores += log_emissions[t]
+            backpointer = workspace.backpointers(backpointer_offsets[t - 2], (n_candidates[t - 1], n_candidates[t]))
+            backpointer[...] = scores.argmax(axis=0)
+            pi = workspace.pi(t, (n_candidates[t - 1], n_candidates[t]))
+            scores.max(axis=0, out=pi)
+
+        # positions of the best path in the candidate lists
+        states = [0] * N_word
+        states[N_word - 2], states[N_word - 1] = np.unravel_index(np.argmax(pi), pi.shape)
         for t in range(N_word - 3, -1, -1):
-            tags_idx[t] = backpointer[t + 2, tags_idx[t + 1], tags_idx[t + 2]]
+            backpointer = workspace.backpointers(backpointer_offsets[t], (n_candidates[t + 1], n_candidates[t + 2]))
+            states[t] = backpointer[states[t + 1], states[t + 2]]
 
-        tag_pred = [self.idx2tag[idx] for idx in tags_idx]
+        tag_pred = [self.idx2tag[candidates[t][states[t]]] for t in range(N_word)]
         return tag_pred
 
+    def viterbi_batch(self, sequences):
+        """
+        Viterbi over several documents at once. The pi slices of all documents at a time step are packed one
+        after the other in a flat array, so one step of the whole batch is a gather, an add and a segment_argmax
+        over the runs of the dropped tag. Documents that already ended have no entries at the later steps, so
+        nothing is padded or masked. Like viterbi, only the pi of the previous step is kept and the indices of a
+        step are built when it is reached. Gives the same tags as viterbi.
+        """
+        order, lengths, token_offsets, prev, candidates, n0, log_emissions = self.get_batch_candidates(sequences)
+        N_batch, N_word = len(sequences), lengths[0]
+        n_running = np.append(np.diff(token_offsets), 0)
+        candidate_offsets = np.cumsum(n0) - n0
+        tokens = np.arange(len(n0))
+        steps = np.repeat(np.arange(N_word), n_running[:-1])
+        # n1 is the number of candidates of the previous word, 1 for the first word
+        n1 = np.where(steps > 0, n0[prev], 1)
+        # pi of a token is a (n1, n0) slice starting at state_bounds[token] - state_bounds[token_offsets[t]]
+        # in the pi of its step t, backpointers are positions in the candidates of the dropped tag
+        state_bounds = np.concatenate([[0], np.cumsum(n1 * n0)])
+        backpointers = np.zeros(state_bounds[-1], dtype=np.uint8 if len(self.all_tags) <= 256 else np.uint16)
+        final_i1, final_i0 = np.zeros(N_batch, dtype=np.int64), np.zeros(N_batch, dtype=np.int64)
+
+        for t in range(N_word):
+            step_tokens = tokens[token_offsets[t]:token_offsets[t + 1]]
+            step_start = state_bounds[token_offsets[t]]
+            if t == 0:
+                # first word, its pi slices are laid out like the candidates
+                first = slice(0, state_bounds[token_offsets[1]])
+                pi = self.log_unigram_probs[candidates[first]] + log_emissions[first]
+            elif t == 1:
+                sizes = n1[step_tokens] * n0[step_tokens]
+                token = np.repeat(step_tokens, sizes)
+                i1, i0 = np.divmod(ragged_arange(sizes), n0[token])
+                cur, last = candidate_offsets[token] + i0, candidate_offsets[prev[token]] + i1
+                pi = pi[state_bounds[prev[token]] - prev_start + i1] + self.log_bigram_probs[candidates[last], candidates[cur]]
+                pi += log_emissions[cur]
+            else:
+                # The scores of a token are ordered (i1, i0, i2) so that every state is a run of the
+                # n2 consecutive scores it maximizes over.
+                sizes = n1[step_tokens] * n0[step_tokens]
+                state_token = np.repeat(step_tokens, sizes)
+                state_i1, state_i0 = np.divmod(ragged_arange(sizes), n0[state_token])
+                run_lengths = n1[prev[state_token]]
+                token, i1, i0 = (np.repeat(a, run_lengths) for a in (state_token, state_i1, state_i0))
+                i2 = ragged_arange(run_lengths)
+                last, last2 = prev[token], prev[prev[token]]
+                scores = pi[state_bounds[last] - prev_start + i2 * n0[last] + i1]
+                scores += self.log_trigram_probs[candidates[candidate_offsets[last2] + i2],
+                                                 candidates[candidate_offsets[last] + i1],
+                                                 candidates[candidate_offsets[token] + i0]]
+                scores += log_emissions[candidate_offsets[token] + i0]
+                states = slice(step_start, state_bounds[token_offsets[t + 1]])
+                pi, backpointers[states] = segment_argmax(scores, run_lengths, i2)
+
+            # Best final state of the documents that end at this step
+            ended = np.arange(n_running[t + 1], n_running[t])
+            if len(ended):
+                token = token_offsets[t] + ended
+                sizes = n1[token] * n0[token]
+                _, best = segment_argmax(pi[np.repeat(state_bounds[token] - step_start, sizes) + ragged_arange(sizes)], sizes)
+                final_i1[ended], final_i0[ended] = np.divmod(best, n0[token])
+            prev_start = step_start
+
+        # Backtracking, all documents at once. A document of length 1 gets i1 = 0 at its only word, then i0.
+        states = np.zeros((N_batch, N_word), dtype=np.int64)
+        states[np.arange(N_batch), np.maximum(lengths - 2, 0)] = final_i1
+        states[np.arange(N_batch), lengths - 1] = final_i0
+        for t in range(N_word - 1, 1, -1):
+            running = slice(0, n_running[t])
+            token = token_offsets[t] + np.arange(n_running[t])
+            states[running, t - 2] = backpointers[state_bounds[token] + states[running, t - 1] * n0[token] + states[running, t]]
+
+        tag_ids = candidates[candidate_offsets + states[tokens - token_offsets[steps], steps]]
+        tag_preds = [None] * N_batch
+        for b, sequence_idx in enumerate(order):
+            tag_preds[sequence_idx] = [self.idx2tag[idx] for idx in tag_ids[token_offsets[:lengths[b]] + b].tolist()]
+        return tag_preds
 
 
 if __name__ == "__main__":
-    pos_tagger = POSTagger()
-    train_data = load_data("data/train_x.csv", "data/train_y.csv")
     dev_data = load_data("data/dev_x.csv", "data/dev_y.csv")
-    test_x = load_data("data/test_x.csv")
 
     emission_threshold = 2
-    pos_tagger.train(train_data, emission_threshold)
+    # Start from the model saved by an earlier run with the same settings and training data, delete the file to retrain
+    model_file = os.path.splitext(os.path.basename(__file__))[0] + '.npz'
+    train_files = ["data/train_x.csv", "data/train_y.csv"]
+    training = training_info(train_files, emission_threshold)
+    try:
+        pos_tagger = POSTagger.load(model_file, training)
+    except (OSError, ValueError):
+        pos_tagger = POSTagger()
+        train_data = Corpus.load(*train_files)
+        pos_tagger.train(train_data, emission_threshold)
+        pos_tagger.save(model_file, training)
 
     # evaluate model by dev_data
     method = 'beam'
     evaluate(dev_data, pos_tagger, method)
 
-    # test prediction
-    test_y = []
-    for sentence in test_x:
-        pred_tags = pos_tagger.inference(method, sentence)  # 可以选择 'viterbi'、'beam'、'greedy'
-        test_y.append(pred_tags)
-
-    flat_predictions = [tag for sent_tags in test_y for tag in sent_tags]
-    ids = list(range(len(flat_predictions)))
-
-    # write the result to the 'test_y.csv' file
-    df = pd.DataFrame({'id': ids, 'tag': flat_predictions})
-    df.to_csv('test_y.csv', index=False)
+    # test prediction, each document is tagged and written to 'test_y.csv' as it is read
+    test_x = iter_data("data/test_x.csv")
+    test_y = (pos_tagger.inference(method, sentence) for sentence in test_x)  # 可以选择 'viterbi'、'beam'、'greedy'
+    write_predictions('test_y.csv', test_y)
     print("Test predictions saved to test_y.csv.")
+    print(f"Word cache: {pos_tagger.word_cache}")
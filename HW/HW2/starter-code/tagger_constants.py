@@ -2,15 +2,23 @@
 STOP_WORD = False
 ### Capitalization
 CAPITALIZATION = True
+### Directory for integer-encoded copies of the loaded corpora (None disables the cache)
+CORPUS_CACHE = 'data/cache'
 
 ### small number
 EPSILON = 1e-100
+### probabilities are clamped to this before taking logs
+MIN_PROB = 1e-10
 
 ### Inference Types ###
 GREEDY = 0
 BEAM = 1; BEAM_K = 2
 VITERBI = 2
 INFERENCE = VITERBI 
+## Bytes of backpointers Viterbi keeps at once, longer documents are decoded in checkpointed segments (None: no limit)
+VITERBI_MEMORY = 64 * 2 ** 20
+## Words whose emissions and candidate tags each process keeps resolved, least recently used first out (None: no limit)
+EMISSION_CACHE_SIZE = 2 ** 16
 
 ### Smoothing Types ###
 LAPLACE = 0; LAPLACE_FACTOR = .2
@@ -21,8 +29,12 @@ SMOOTHING = INTERPOLATION
 
 # NGRAMM
 NGRAMM = 3
+## Store 4-gram probabilities only for observed 3-tag contexts
+SPARSE_FOURGRAMS = False
 
 ## Handle unknown words TnT style
 TNT_UNK = True
 UNK_C = 2 #words with count to be considered, don't change, it's the best threshold
 UNK_M = 5 #substring length to be considered
+## Only score the tags a word (or its suffix) was seen with in training
+TAG_DICT = True
@@ -1,43 +1,147 @@
+import copy
+import csv
+import hashlib
+import itertools
+import json
+import math
+import os
+import zipfile
+from collections import OrderedDict
 import pandas as pd
-from tqdm import tqdm 
 import numpy as np
+from multiprocessing import shared_memory
 import seaborn as sn
 import matplotlib.pyplot as plt
 from tagger_constants import *
 
 
-def infer_sentences(model, sentences, start, method):
+# Model and documents of a pool worker, set once by init_worker so that tasks only carry index ranges
+worker_state = {}
+# Shared memory blocks attached by this process, they must stay open while their arrays are used
+attached_memory = []
+
+
+class SharedArray():
+    """Handle of a numpy array placed in shared memory by SharedModel, cheap to pickle."""
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def attach(self):
+        """Returns the array, backed by the shared memory block without copying."""
+        memory = shared_memory.SharedMemory(name=self.name)
+        attached_memory.append(memory)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=memory.buf)
+
+
+class SharedModel():
+    """Context manager that places the decoding tables of a model in shared memory for pool workers.
+
+    model is a lean copy (see POSTagger.__getstate__) of the given model in which every array
+    attribute, and the arrays of SparseNgramProbs, SuffixTrie and TagDict tables, is a SharedArray handle.
+    Workers turn the handles back into arrays with attach_shared_model, so all of them read the same
+    memory no matter how many there are. The shared memory is released on exit.
     """
+    def __init__(self, model):
+        self.blocks = []
+        self.model = copy.copy(model)
+        try:
+            for name, value in vars(self.model).items():
+                if isinstance(value, np.ndarray):
+                    setattr(self.model, name, self.share(value))
+                elif isinstance(value, (SparseNgramProbs, SuffixTrie, TagDict)):
+                    table = copy.copy(value)
+                    for field in value.ARRAYS:
+                        setattr(table, field, self.share(getattr(value, field)))
+                    setattr(self.model, name, table)
+        except BaseException:
+            self.__exit__(None, None, None)  # release the blocks created so far
+            raise
+
+    def share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return SharedArray(block.name, array.shape, array.dtype)
+
+    def __enter__(self):
+        return self.model
+
+    def __exit__(self, *exc_info):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_shared_model(model):
+    """Replaces the SharedArray handles of a model made by SharedModel with the shared arrays."""
+    for name, value in vars(model).items():
+        if isinstance(value, SharedArray):
+            setattr(model, name, value.attach())
+        elif isinstance(value, (SparseNgramProbs, SuffixTrie, TagDict)) and isinstance(getattr(value, value.ARRAYS[0]), SharedArray):
+            table = copy.copy(value)
+            for field in value.ARRAYS:
+                setattr(table, field, getattr(value, field).attach())
+            setattr(model, name, table)
+    return model
+
+
+def init_worker(model, sentences, tags=None):
+    """Pool initializer, keeps the model and the evaluation documents in the worker process.
+
     Args:
-        model (POSTagger): model used for inference
-        sentences (list[str]): list of sentences to infer by single process
-        start (int): index of first sentence in sentences in the original list of sentences
+        model (POSTagger): model used for inference, its tables can be in shared memory (see SharedModel)
+        sentences (list[list[str]]): all documents of the evaluation
+        tags (list[list[str]]): their gold tags
+    """
+    worker_state.update(model=attach_shared_model(copy.copy(model)), sentences=sentences, tags=tags)
+
+
+def infer_documents(doc_indices, method):
+    """Tags the documents with the given indices among those given to init_worker.
 
     Returns:
-        dict: index, predicted tags for each sentence in sentences
+        dict: index, predicted tags for each sentence
     """
-    res = {}
-    for i in range(len(sentences)):
-        res[start+i] = model.inference(method, sentences[i])
-    return res
-    
-def compute_prob(model, sentences, tags, start):
-    """
-    Args:
-        model (POSTagger): model used for inference
-        sentences (list[str]): list of sentences 
-        sentences (list[str]): list of tags
-        start (int): index of first sentence in sentences in the original list of sentences
+    model, sentences = worker_state['model'], worker_state['sentences']
+    return {i: model.inference(method, sentences[i]) for i in doc_indices}
 
 
+def compute_prob_documents(doc_indices):
+    """Computes the probabilities of the documents with the given indices among those given to init_worker.
+
     Returns:
         dict: index, probability for each sentence,tag pair
     """
-    res = {}
-    for i in range(len(sentences)):
-        res[start+i] = model.sequence_probability(sentences[i], tags[i])
-    return res # 为一组句子及其对应的词性标签计算它们的概率，并将每个句子及标签对的概率存储在字典 res 中
-    
+    model, sentences, tags = worker_state['model'], worker_state['sentences'], worker_state['tags']
+    return {i: model.sequence_probability(sentences[i], tags[i]) for i in doc_indices}
+
+
+def schedule_chunks(lengths, processes, chunks_per_process=8):
+    """Groups documents into small chunks for the shared task queue of a pool, most expensive first.
+
+    Decoding cost is estimated by document length. Documents are sorted by decreasing length and cut
+    into chunks of about total_length / (processes * chunks_per_process) tokens, so the long documents
+    are started first and the short ones even out the workers at the end.
+
+    Args:
+        lengths (list[int]): length of every document
+        processes (int): number of workers
+        chunks_per_process (int): how many chunks each worker gets on average
+
+    Returns:
+        list[list[int]]: the document indices of every chunk, in the order they should be submitted
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(-lengths, kind='stable')
+    chunk_tokens = max(lengths.sum() / (processes * chunks_per_process), 1)
+    # Chunk of every document: tokens of the longer documents before it, in units of chunk_tokens
+    chunk_ids = ((np.cumsum(lengths[order]) - lengths[order]) // chunk_tokens).astype(np.int64)
+    split_indexes = np.flatnonzero(np.diff(chunk_ids)) + 1
+    return [chunk.tolist() for chunk in np.split(order, split_indexes) if len(chunk)]
+
 
 #from https://stackoverflow.com/questions/6294179/how-to-find-all-occurrences-of-an-element-in-a-list    
 def indices(lst, element): # 查找元素在list中的所有index
@@ -51,6 +155,715 @@ def indices(lst, element): # 查找元素在list中的所有index
         result.append(offset)
 
 
+def encode_sequences(sequences, index):
+    """Encodes a list of sequences into one flat integer array.
+
+    Args:
+        sequences (list[list[str]]): documents to encode
+        index (dict): symbol to integer id dictionary
+
+    Returns:
+        np.ndarray: ids of all symbols, documents concatenated
+        np.ndarray: document offsets, document i is ids[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in sequences], out=offsets[1:])
+    ids = np.fromiter((index[x] for s in sequences for x in s), dtype=np.int64, count=offsets[-1])
+    return ids, offsets
+
+
+def factorize_sequences(sequences):
+    """Encodes a list of sequences into one flat integer array, numbering symbols by first occurrence.
+
+    Args:
+        sequences (list[list[str]]): documents to encode
+
+    Returns:
+        np.ndarray: ids of all symbols, documents concatenated
+        np.ndarray: distinct symbols (object array), symbols[ids[i]] is the i-th symbol
+        np.ndarray: document offsets, document i is ids[offsets[i]:offsets[i+1]]
+    """
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in sequences], out=offsets[1:])
+    flat = np.array([x for s in sequences for x in s], dtype=object)
+    ids, symbols = pd.factorize(flat)
+    return ids.astype(np.int64), symbols, offsets
+
+
+def encode_training_data(data):
+    """Integer-encodes training data given as a Corpus or as the (sentences, tags) lists of load_data.
+
+    Args:
+        data: the training documents
+
+    Returns:
+        list[str]: the distinct tags in sorted order, tag ids index this list
+        np.ndarray: tag ids of all tokens, documents concatenated
+        np.ndarray: document offsets
+        np.ndarray: word ids of all tokens, numbered by first occurrence
+        np.ndarray: distinct words (object array), words[word_ids[i]] is the i-th word
+    """
+    if isinstance(data, Corpus):
+        # Renumber by first occurrence, so that vocabulary entries unused by a slice of a corpus are dropped
+        word_ids, word_index = pd.factorize(data.word_ids)
+        tag_ids, tag_index = pd.factorize(data.tag_ids)
+        tags = data.tag_vocab[tag_index]
+        all_tags = sorted(set(tags))
+        tag2idx = {tag: i for i, tag in enumerate(all_tags)}
+        tag_map = np.array([tag2idx[tag] for tag in tags], dtype=np.int64)
+        return all_tags, tag_map[tag_ids], data.offsets, word_ids.astype(np.int64), data.word_vocab[word_index]
+
+    all_tags = sorted(set([t for tag in data[1] for t in tag]))
+    tag_ids, offsets = encode_sequences(data[1], {tag: i for i, tag in enumerate(all_tags)})
+    word_ids, words, _ = factorize_sequences(data[0])
+    return all_tags, tag_ids, offsets, word_ids, words
+
+
+def ngram_counts(ids, offsets, n, size):
+    """Counts the n-grams of an encoded corpus that do not cross document boundaries.
+
+    Args:
+        ids (np.ndarray): flat symbol ids, as returned by encode_sequences
+        offsets (np.ndarray): document offsets, as returned by encode_sequences
+        n (int): order of the n-grams
+        size (int): number of distinct symbols
+
+    Returns:
+        np.ndarray: counts of shape (size,) * n, counts[i, j, ...] = Count(i, j, ...)
+    """
+    counts = np.bincount(ngram_codes(ids, offsets, n, size), minlength=size ** n)
+    return counts.reshape((size,) * n).astype(float)
+
+
+def ngram_codes(ids, offsets, n, size):
+    """Codes of the n-grams of an encoded corpus that do not cross document boundaries, see ngram_counts.
+
+    Returns:
+        np.ndarray: one code per n-gram occurrence, the flat index of the n-gram in a (size,) * n array
+    """
+    n_windows = max(len(ids) - n + 1, 0)
+    doc_of = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    # a window is valid if its first and last symbols belong to the same document
+    valid = doc_of[:n_windows] == doc_of[n - 1:n - 1 + n_windows]
+    codes = np.zeros(n_windows, dtype=np.int64)
+    for k in range(n):
+        codes = codes * size + ids[k:k + n_windows]
+    return codes[valid]
+
+
+def suffix_tag_counts(words, word_tag_counts, max_len):
+    """Groups the tag counts of words by their suffixes of length 1 to max_len.
+
+    Args:
+        words (np.ndarray): distinct words
+        word_tag_counts (np.ndarray): tag counts of every word, shape (len(words), N_tag)
+        max_len (int): length of the longest suffix
+
+    Returns:
+        np.ndarray: distinct suffixes
+        np.ndarray: tag counts of every suffix, shape (len(suffixes), N_tag)
+    """
+    suffixes = []
+    rows = []
+    for row, word in enumerate(words):
+        for m in range(1, min(len(word), max_len) + 1):
+            suffixes.append(word[-m:])
+            rows.append(row)
+    suffix_ids, distinct_suffixes = pd.factorize(np.array(suffixes, dtype=object))
+    counts = np.zeros((len(distinct_suffixes), word_tag_counts.shape[1]))
+    np.add.at(counts, suffix_ids, word_tag_counts[rows])
+    return distinct_suffixes, counts
+
+
+def interpolate_ngram_probs(counts, lambdas):
+    """Linearly interpolates the relative frequencies of n-gram counts of decreasing order.
+
+    Lower order counts are broadcast against the higher order ones, so each
+    marginal is computed once instead of once per cell.
+
+    Args:
+        counts (list[np.ndarray]): n-gram counts, highest order first, e.g. [trigram_counts, bigram_counts, unigram_counts]
+        lambdas (list[float]): interpolation weight of each order, same order as counts
+
+    Returns:
+        np.ndarray: interpolated probabilities, same shape as counts[0]
+    """
+    probs = np.zeros(counts[0].shape)
+    for lambda_i, order_counts in zip(lambdas, counts):
+        totals = order_counts.sum(axis=-1, keepdims=True)
+        probs += lambda_i * ((order_counts + EPSILON) / (totals + EPSILON))
+    return probs
+
+
+class SparseNgramProbs():
+    """Interpolated n-gram probabilities that store a dense row only for the contexts seen in training.
+
+    A context (t_1, ..., t_{n-1}) that never occurs has no n-gram counts, so its
+    highest order relative frequency is the constant (0 + EPSILON) / (0 + EPSILON)
+    and its row only depends on (t_2, ..., t_{n-1}). These rows are read from a
+    backoff table with one dimension less than the dense tensor.
+
+    Indexing takes one integer or integer array per dimension (arrays broadcast
+    like np.ix_ output) and returns the same values as the dense tensor.
+    """
+    ARRAYS = ('context_index', 'rows', 'backoff')
+
+    def __init__(self, context_index, rows, backoff):
+        self.context_index = context_index  # row of each context, -1 if the context is unseen
+        self.rows = rows
+        self.backoff = backoff
+        self.ndim = context_index.ndim + 1
+        self.shape = context_index.shape + rows.shape[1:]
+
+    @classmethod
+    def from_codes(cls, codes, size, lower_counts, lambdas):
+        """Builds the table from the observed n-grams, without making the dense n-gram counts.
+
+        Args:
+            codes (np.ndarray): the n-gram occurrences, as returned by ngram_codes
+            size (int): number of distinct symbols
+            lower_counts (list[np.ndarray]): dense counts of the lower orders, highest first
+            lambdas (list[float]): interpolation weight of each order, the n-grams first
+        """
+        n = len(lower_counts) + 1
+        contexts, context_of = np.unique(codes // size, return_inverse=True)
+        context_counts = np.bincount(context_of * size + codes % size, minlength=len(contexts) * size)
+        context_counts = context_counts.reshape(len(contexts), size).astype(float)
+        context_index = np.full((size,) * (n - 1), -1, dtype=np.int32)
+        context_index.flat[contexts] = np.arange(len(contexts), dtype=np.int32)
+        seen_contexts = np.unravel_index(contexts, context_index.shape)
+
+        rows = lambdas[0] * ((context_counts + EPSILON) / (context_counts.sum(axis=1, keepdims=True) + EPSILON))
+        backoff = np.full(context_index.shape, lambdas[0] * 1.0)
+        for lambda_i, order_counts in zip(lambdas[1:], lower_counts):
+            probs = (order_counts + EPSILON) / (order_counts.sum(axis=-1, keepdims=True) + EPSILON)
+            # the lower order context is the tail of the full context
+            rows += lambda_i * probs[seen_contexts[len(seen_contexts) - probs.ndim + 1:]]
+            backoff += lambda_i * probs
+        return cls(context_index, rows, backoff)
+
+    def __getitem__(self, key):
+        *context, last = key
+        row = self.context_index[tuple(context)]
+        seen_probs = self.rows[np.maximum(row, 0), last]
+        unseen_probs = self.backoff[tuple(context[1:]) + (last,)]
+        return np.where(row >= 0, seen_probs, unseen_probs)
+
+    def clamped_log(self, min_prob):
+        """Returns the table of log(max(p, min_prob))."""
+        return SparseNgramProbs(self.context_index,
+                                np.log(np.maximum(self.rows, min_prob)),
+                                np.log(np.maximum(self.backoff, min_prob)))
+
+    def todense(self):
+        return self[np.ix_(*[np.arange(n) for n in self.shape])]
+
+
+class SuffixTrie():
+    """Per suffix values (e.g. tag distributions) in a trie over the reversed characters of the suffixes.
+
+    Node 0 is the root, the empty suffix. The edge from node p with character c has the key
+    p << 21 | ord(c) (code points fit in 21 bits) in the sorted edge_keys, and leads to the node at the
+    same position of edge_children. values[n] is the value of the suffix spelled by the path to node n,
+    if has_value[n]. Matching the longest stored suffix of a word is a single walk from the root.
+    """
+    ARRAYS = ('edge_keys', 'edge_children', 'values', 'has_value')
+
+    def __init__(self, edge_keys, edge_children, values, has_value):
+        self.edge_keys = edge_keys
+        self.edge_children = edge_children
+        self.values = values
+        self.has_value = has_value
+        self.edge_index = None  # the edges as a dict, for single lookups, built on first use
+
+    @classmethod
+    def from_suffixes(cls, suffixes, values):
+        """Builds the trie of the given suffixes, values[i] is the value of suffixes[i]."""
+        edges = {}
+        suffix_nodes = []
+        for suffix in suffixes:
+            node = 0
+            for char in reversed(suffix):
+                node = edges.setdefault(node << 21 | ord(char), len(edges) + 1)
+            suffix_nodes.append(node)
+        edge_keys = np.array(sorted(edges), dtype=np.int64)
+        edge_children = np.array([edges[key] for key in edge_keys.tolist()], dtype=np.int64)
+        node_values = np.zeros((len(edges) + 1,) + values.shape[1:], dtype=values.dtype)
+        node_values[suffix_nodes] = values
+        has_value = np.zeros(len(edges) + 1, dtype=bool)
+        has_value[suffix_nodes] = True
+        return cls(edge_keys, edge_children, node_values, has_value)
+
+    def with_values(self, values):
+        """Returns a trie of the same suffixes with other values, e.g. a function of self.values."""
+        return SuffixTrie(self.edge_keys, self.edge_children, values, self.has_value)
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def longest_suffix(self, word):
+        """Returns the node of the longest suffix of word that has a value, -1 if there is none."""
+        if self.edge_index is None:
+            self.edge_index = dict(zip(self.edge_keys.tolist(), self.edge_children.tolist()))
+        best = -1
+        node = 0
+        for char in reversed(word):
+            node = self.edge_index.get(node << 21 | ord(char))
+            if node is None:
+                break
+            if self.has_value[node]:
+                best = node
+        return best
+
+    def longest_suffixes(self, words):
+        """longest_suffix of several words, walking the trie one character position at a time for all of them."""
+        best = np.full(len(words), -1, dtype=np.int64)
+        if not words or len(self.edge_keys) == 0:
+            return best
+        depth = max(len(word) for word in words)
+        chars = np.full((len(words), depth), -1, dtype=np.int64)
+        for i, word in enumerate(words):
+            chars[i, :len(word)] = [ord(char) for char in reversed(word)]
+        nodes = np.zeros(len(words), dtype=np.int64)
+        alive = np.ones(len(words), dtype=bool)
+        for d in range(depth):
+            keys = nodes << 21 | chars[:, d]
+            positions = np.minimum(np.searchsorted(self.edge_keys, keys), len(self.edge_keys) - 1)
+            alive &= (chars[:, d] >= 0) & (self.edge_keys[positions] == keys)
+            if not alive.any():
+                break
+            nodes = np.where(alive, self.edge_children[positions], 0)
+            best = np.where(alive & self.has_value[nodes], nodes, best)
+        return best
+
+
+class TagDict():
+    """Candidate tag ids of every word (or suffix trie node), stored like a CSR matrix.
+
+    The candidates of entry i are tag_ids[offsets[i]:offsets[i+1]], in increasing order. Two flat arrays
+    instead of one small array per entry can be shared between processes and saved as they are.
+    """
+    ARRAYS = ('tag_ids', 'offsets')
+
+    def __init__(self, tag_ids, offsets):
+        self.tag_ids = tag_ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Builds the dictionary whose entry i holds the tags t with mask[i, t]."""
+        entries, tag_ids = np.nonzero(mask)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(entries, minlength=len(mask)))])
+        return cls(tag_ids, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tag_ids[self.offsets[i]:self.offsets[i + 1]]
+
+
+class ViterbiWorkspace():
+    """Buffers that Viterbi reuses across calls instead of allocating full lattices per document.
+
+    Only the previous and the current pi slices are kept, in two ping-pong buffers.
+    The backpointers of every step are stored as small unsigned integers (positions
+    in the candidate list of the dropped tag) in one flat buffer that only grows
+    when a longer document arrives.
+    """
+    def __init__(self, n_tag, order=3):
+        state_size = n_tag ** (order - 1)
+        self.backpointer_dtype = np.uint8 if n_tag <= 256 else np.uint16
+        self.pi_buffers = [np.empty(state_size), np.empty(state_size)]
+        self.scores_buffer = np.empty(state_size * n_tag)
+        self.backpointer_buffer = np.empty(0, dtype=self.backpointer_dtype)
+
+    def reserve(self, n_backpointers):
+        """Makes room for n_backpointers backpointers."""
+        if self.backpointer_buffer.size < n_backpointers:
+            size = max(n_backpointers, 2 * self.backpointer_buffer.size)
+            self.backpointer_buffer = np.empty(size, dtype=self.backpointer_dtype)
+
+    def pi(self, t, shape):
+        """Returns the pi slice of time step t, it shares memory with step t - 2."""
+        return self.pi_buffers[t % 2][:math.prod(shape)].reshape(shape)
+
+    def scores(self, shape):
+        return self.scores_buffer[:math.prod(shape)].reshape(shape)
+
+    def backpointers(self, offset, shape):
+        return self.backpointer_buffer[offset:offset + math.prod(shape)].reshape(shape)
+
+
+class LRUCache():
+    """Bounded cache that drops the least recently used entry when full, and counts its hits and misses.
+
+    Args:
+        maxsize: Maximum number of entries, None for no limit.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """Returns the entry of key, computing it as compute(key) on a miss. Entries must not be None."""
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.entries[key] = compute(key)
+        if self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def get_many(self, keys, compute_many):
+        """Like get for every key, the missing entries are computed together as compute_many(missing keys).
+
+        The values of the call are collected before anything is evicted, so the cache can be smaller than keys.
+        """
+        values, missing = {}, []
+        for key in dict.fromkeys(keys):
+            value = self.entries.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                self.entries.move_to_end(key)
+                values[key] = value
+        if missing:
+            values.update(zip(missing, compute_many(missing)))
+            for key in missing:
+                self.entries[key] = values[key]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        while self.maxsize is not None and len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return [values[key] for key in keys]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return f'{len(self.entries)} entries, {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.1%}'
+
+
+def top_k(scores, k):
+    """Returns the indices of the k largest scores (all of them if there are fewer), in no particular order."""
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    return np.argpartition(scores, -k)[-k:]
+
+
+def ragged_arange(sizes):
+    """Concatenation of np.arange(n) for every n in sizes."""
+    ends = np.cumsum(sizes)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - sizes, sizes)
+
+
+def document_sums(values, offsets):
+    """Sums of per token values over the documents of a corpus with the given offsets, 0 for empty documents."""
+    lengths = np.diff(offsets)
+    sums = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def segment_argmax(values, sizes, positions=None):
+    """Maximum and position of the first maximum of consecutive runs of values.
+
+    Args:
+        values: Flat array made of runs of sizes[0], sizes[1], ... values, all sizes at least 1.
+        sizes: Length of every run.
+        positions: ragged_arange(sizes), if it is already known.
+
+    Returns:
+        The maximum of every run and its position inside the run, the first one on ties like np.argmax.
+    """
+    starts = np.cumsum(sizes) - sizes
+    maxima = np.maximum.reduceat(values, starts)
+    positions = ragged_arange(sizes) if positions is None else positions.copy()
+    positions[values != np.repeat(maxima, sizes)] = np.iinfo(positions.dtype).max
+    return maxima, np.minimum.reduceat(positions, starts)
+
+
+def viterbi_segments(backpointer_sizes, budget):
+    """Splits the time steps of a document into segments whose backpointers fit in budget.
+
+    Args:
+        backpointer_sizes: Number of backpointer bytes of every time step.
+        budget: Maximum number of bytes per segment, None for a single segment.
+
+    Returns:
+        The first time step of every segment, starting with 0. A step larger than
+        the budget on its own gets a segment of its own.
+    """
+    starts = [0]
+    if budget is None:
+        return starts
+    size = 0
+    for t, step_size in enumerate(backpointer_sizes):
+        if size > 0 and size + step_size > budget:
+            starts.append(t)
+            size = 0
+        size += step_size
+    return starts
+
+
+def can_encode_strings(strings):
+    """Whether encode_strings can store strings: they must be str without NUL characters."""
+    return all(isinstance(string, str) and '\0' not in string for string in strings)
+
+
+def encode_strings(strings):
+    """Stores a list of strings compactly as NUL-separated UTF-8 bytes (uint8 array)."""
+    return np.frombuffer('\0'.join(strings).encode(), dtype=np.uint8)
+
+
+def decode_strings(data, n=None):
+    """Inverse of encode_strings, n is the number of strings (needed to tell [] from [''])."""
+    if n == 0:
+        return []
+    return data.tobytes().decode().split('\0')
+
+
+def corpus_cache_path(files):
+    """Returns the cache directory of a corpus, named after the content of its files and the loading settings.
+
+    Args:
+        files (list[str]): the CSV files the corpus is loaded from
+
+    Returns:
+        str: a directory under CORPUS_CACHE
+    """
+    return os.path.join(CORPUS_CACHE, files_digest(files, CAPITALIZATION, STOP_WORD))
+
+
+def files_digest(files, *settings):
+    """Returns the sha1 hex digest of repr(settings) followed by the content of files."""
+    digest = hashlib.sha1(repr(settings).encode())
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_corpus_cache(cache_dir, columns):
+    """Stores a corpus as .npy files: the ids and the vocabulary of every column, plus the document offsets.
+
+    Vocabularies are stored as NUL-separated UTF-8 bytes, corpora with other symbols than such strings are not cached.
+
+    Args:
+        cache_dir (str): directory to create, see corpus_cache_path
+        columns (dict[str, list[list[str]]]): the loaded documents, e.g. {'word': sentences, 'tag': tags}
+    """
+    encoded = {name: factorize_sequences(sequences) for name, sequences in columns.items()}
+    if not all(can_encode_strings(symbols) for _, symbols, _ in encoded.values()):
+        return
+    os.makedirs(CORPUS_CACHE, exist_ok=True)
+    ignore_file = os.path.join(CORPUS_CACHE, '.gitignore')
+    if not os.path.exists(ignore_file):
+        with open(ignore_file, 'w') as f:
+            f.write('*\n')
+    # Write to a temporary directory first so that a partly written cache is never read
+    tmp_dir = f'{cache_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, (ids, symbols, offsets) in encoded.items():
+        np.save(os.path.join(tmp_dir, f'{name}_ids.npy'), ids.astype(np.int32))
+        np.save(os.path.join(tmp_dir, f'{name}_vocab.npy'), encode_strings(symbols))
+    np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:  # written by another process in the meantime
+        for file in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, file))
+        os.rmdir(tmp_dir)
+
+
+def read_corpus_cache(cache_dir, names):
+    """Memory-maps a corpus stored by write_corpus_cache.
+
+    Args:
+        cache_dir (str): the cache directory
+        names (list[str]): the columns to read, e.g. ['word', 'tag']
+
+    Returns:
+        dict: for every name, '<name>_ids' (int32 memory map) and '<name>_vocab' (list[str]),
+            plus 'offsets', document i is ids[offsets[i]:offsets[i+1]]
+    """
+    corpus = {'offsets': np.load(os.path.join(cache_dir, 'offsets.npy'), mmap_mode='r')}
+    for name in names:
+        corpus[f'{name}_ids'] = np.load(os.path.join(cache_dir, f'{name}_ids.npy'), mmap_mode='r')
+        corpus[f'{name}_vocab'] = decode_strings(np.load(os.path.join(cache_dir, f'{name}_vocab.npy')))
+    return corpus
+
+
+def decode_sequences(ids, vocab, offsets):
+    """Turns encoded documents back into lists of symbols."""
+    symbols = np.array(vocab, dtype=object)[ids]
+    return [doc.tolist() for doc in np.split(symbols, offsets[1:-1])]
+
+
+# Version of the model artifacts written by save_artifact, loading other versions fails
+ARTIFACT_VERSION = 4
+
+
+def model_config():
+    """Returns the constants of tagger_constants that a trained model depends on."""
+    config = {name: globals()[name] for name in
+              ('CAPITALIZATION', 'STOP_WORD', 'EPSILON', 'MIN_PROB', 'SMOOTHING', 'LAPLACE_FACTOR', 'LAMBDAS',
+               'NGRAMM', 'SPARSE_FOURGRAMS', 'TNT_UNK', 'UNK_C', 'UNK_M', 'TAG_DICT')}
+    return json.loads(json.dumps(config))  # tuples become lists, as when read back from an artifact
+
+
+def training_info(files, emission_threshold):
+    """Describes what a model is trained on: the content of its training files and its emission threshold."""
+    return {'data': files_digest(files), 'emission_threshold': emission_threshold}
+
+
+def artifact_checksum(arrays):
+    """SHA-256 of the names, types, shapes and contents of the arrays of an artifact."""
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def save_artifact(path, state, training=None):
+    """Writes the attributes of a model to an .npz file, with the model config, a version and a checksum.
+
+    Supported attribute values are None, numpy arrays, SparseNgramProbs, SuffixTrie, TagDict, lists of
+    strings, lists of arrays, dicts from strings to arrays and dicts between strings and integers. Dict
+    entries are stored in key order, so the same model always gives the same file.
+
+    Args:
+        path (str): the .npz file
+        state (dict): attribute name to value, e.g. model.__getstate__()
+        training (dict): what the model was trained on, see training_info
+    """
+    arrays, kinds = {}, {}
+    for name, value in sorted(state.items()):
+        if value is None:
+            kinds[name] = 'none'
+        elif isinstance(value, np.ndarray):
+            kinds[name] = 'array'
+            arrays[name] = value
+        elif isinstance(value, SparseNgramProbs):
+            kinds[name] = 'sparse'
+            for field in SparseNgramProbs.ARRAYS:
+                arrays[f'{name}.{field}'] = getattr(value, field)
+        elif isinstance(value, SuffixTrie):
+            kinds[name] = 'trie'
+            for field in SuffixTrie.ARRAYS:
+                arrays[f'{name}.{field}'] = getattr(value, field)
+        elif isinstance(value, TagDict):
+            kinds[name] = 'tag_dict'
+            for field in TagDict.ARRAYS:
+                arrays[f'{name}.{field}'] = getattr(value, field)
+        elif isinstance(value, list) and can_encode_strings(value):
+            kinds[name] = 'strings'
+            arrays[f'{name}.strings'] = encode_strings(value)
+            arrays[f'{name}.length'] = np.array(len(value))
+        elif isinstance(value, list):
+            kinds[name] = 'arrays'
+            arrays[f'{name}.lengths'] = np.array([len(a) for a in value], dtype=np.int64)
+            arrays[f'{name}.values'] = np.concatenate(value) if value else np.empty(0)
+        elif isinstance(value, dict) and can_encode_strings(value.keys()):
+            keys = sorted(value)
+            arrays[f'{name}.keys'] = encode_strings(keys)
+            arrays[f'{name}.length'] = np.array(len(keys))
+            if all(isinstance(v, (int, np.integer)) for v in value.values()):
+                kinds[name] = 'str_to_int'
+                arrays[f'{name}.values'] = np.array([value[k] for k in keys], dtype=np.int64)
+            else:
+                kinds[name] = 'str_to_array'
+                arrays[f'{name}.lengths'] = np.array([len(value[k]) for k in keys], dtype=np.int64)
+                arrays[f'{name}.values'] = np.concatenate([value[k] for k in keys]) if keys else np.empty(0)
+        elif isinstance(value, dict) and can_encode_strings(value.values()):
+            kinds[name] = 'int_to_str'
+            keys = sorted(value)
+            arrays[f'{name}.keys'] = np.array(keys, dtype=np.int64)
+            arrays[f'{name}.values'] = encode_strings([value[k] for k in keys])
+        else:
+            raise TypeError(f'cannot save attribute {name} of type {type(value).__name__}')
+    meta = {'version': ARTIFACT_VERSION, 'kinds': kinds, 'config': model_config(), 'training': training,
+            'checksum': artifact_checksum(arrays)}
+    arrays['meta'] = encode_strings([json.dumps(meta, sort_keys=True)])
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def load_artifact(path, training=None):
+    """Reads the attributes of a model written by save_artifact.
+
+    Args:
+        path (str): the .npz file
+        training (dict): if given, what the model must have been trained on, see training_info
+
+    Raises:
+        ValueError: if the artifact has another version, is corrupted, was trained with another
+            model_config() than the current one, or on other training data than training
+
+    Returns:
+        dict: attribute name to value
+    """
+    try:
+        with np.load(path) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+    except zipfile.BadZipFile as e:
+        raise ValueError(f'{path} is corrupted: {e}')
+    meta = json.loads(decode_strings(arrays.pop('meta'))[0])
+    if meta['version'] != ARTIFACT_VERSION:
+        raise ValueError(f'{path} has artifact version {meta["version"]}, expected {ARTIFACT_VERSION}')
+    if meta['checksum'] != artifact_checksum(arrays):
+        raise ValueError(f'{path} is corrupted, its checksum does not match')
+    config = model_config()
+    changed = sorted(name for name in config if meta['config'].get(name) != config[name])
+    if changed:
+        raise ValueError(f'{path} was trained with other settings of {", ".join(changed)}')
+    if training is not None and meta.get('training') != json.loads(json.dumps(training)):
+        raise ValueError(f'{path} was trained on other data or with another emission threshold')
+
+    state = {}
+    for name, kind in meta['kinds'].items():
+        if kind == 'none':
+            state[name] = None
+        elif kind == 'array':
+            state[name] = arrays[name]
+        elif kind == 'sparse':
+            state[name] = SparseNgramProbs(*[arrays[f'{name}.{field}'] for field in SparseNgramProbs.ARRAYS])
+        elif kind == 'trie':
+            state[name] = SuffixTrie(*[arrays[f'{name}.{field}'] for field in SuffixTrie.ARRAYS])
+        elif kind == 'tag_dict':
+            state[name] = TagDict(*[arrays[f'{name}.{field}'] for field in TagDict.ARRAYS])
+        elif kind == 'strings':
+            state[name] = decode_strings(arrays[f'{name}.strings'], int(arrays[f'{name}.length']))
+        elif kind == 'arrays':
+            state[name] = np.split(arrays[f'{name}.values'], np.cumsum(arrays[f'{name}.lengths'])[:-1])
+        elif kind == 'int_to_str':
+            values = decode_strings(arrays[f'{name}.values'], len(arrays[f'{name}.keys']))
+            state[name] = dict(zip(arrays[f'{name}.keys'].tolist(), values))
+        else:
+            keys = decode_strings(arrays[f'{name}.keys'], int(arrays[f'{name}.length']))
+            if kind == 'str_to_int':
+                state[name] = dict(zip(keys, arrays[f'{name}.values'].tolist()))
+            else:
+                values = np.split(arrays[f'{name}.values'], np.cumsum(arrays[f'{name}.lengths'])[:-1])
+                state[name] = dict(zip(keys, values))
+    return state
+
+
 def load_data(sentence_file, tag_file=None):
     """Loads data from two files: one containing sentences and one containing tags.
 
@@ -58,44 +871,203 @@ def load_data(sentence_file, tag_file=None):
 
     Suggested to split the data by the document-start symbol.
 
+    When CORPUS_CACHE is set, the documents are also stored there integer-encoded, keyed by the
+    content of the files and the CAPITALIZATION / STOP_WORD settings, and later loads read that copy.
+
     """
-    df_sentences = pd.read_csv(open(sentence_file))
-    doc_start_indexes = df_sentences.index[df_sentences['word'] == '-DOCSTART-'].tolist()
-    num_sentences = len(doc_start_indexes)
+    names = ['word', 'tag'] if tag_file else ['word']
+    cache_dir = None
+    if CORPUS_CACHE is not None:
+        cache_dir = corpus_cache_path([sentence_file, tag_file] if tag_file else [sentence_file])
+        if os.path.isdir(cache_dir):
+            corpus = read_corpus_cache(cache_dir, names)
+            columns = [decode_sequences(corpus[f'{name}_ids'], corpus[f'{name}_vocab'], corpus['offsets'])
+                       for name in names]
+            return tuple(columns) if tag_file else columns[0]
+
+    columns = read_csv_corpus(sentence_file, tag_file)
+    if cache_dir is not None and len(columns[0]) > 0:
+        write_corpus_cache(cache_dir, dict(zip(names, columns)))
+    return columns if tag_file else columns[0]
+
+
+def normalize_words(column):
+    """Strips the words of a CSV column and lowercases them according to CAPITALIZATION.
+
+    Args:
+        column (pd.Series): the 'word' column
+
+    Returns:
+        np.ndarray: the words (object array)
+        np.ndarray: mask of the '-DOCSTART-' rows
+    """
+    # str() of a missing cell is 'nan', which is how the words used to be read cell by cell. The readers ask
+    # for str columns, astype(str) covers a column that pandas still parsed as numbers.
+    words = column.fillna('nan').astype(str).str.strip()
+    is_doc_start = (words == '-DOCSTART-').to_numpy()
+    if not CAPITALIZATION:
+        words = words.str.lower()
+    else:
+        words = words.where(~is_doc_start, '-docstart-')
+    return words.to_numpy(dtype=object), is_doc_start
 
-    sentences = [] # each sentence is a list of tuples (index,word)
-    if tag_file:
-        df_tags = pd.read_csv(open(tag_file))
-        tags = []
-    for i in tqdm(range(num_sentences)):
-        index = doc_start_indexes[i]
-        if i == num_sentences-1:
-            # handle last sentence
-            next_index = len(df_sentences)
-        else:
-            next_index = doc_start_indexes[i+1]
-
-        sent = []
-        tag = []
-        for j in range(index, next_index):
-            word = str(df_sentences['word'][j]).strip()
-            if not CAPITALIZATION or word == '-DOCSTART-':
-                word = word.lower()
-            sent.append(word)
-            if tag_file:
-                tag.append((df_tags['tag'][j]))
-        if STOP_WORD:
-            sent.append('<STOP>')
-        sentences.append(sent)
-        if tag_file:
-            if STOP_WORD:
-                tag.append('<STOP>')
-            tags.append(tag)
 
+def read_csv_corpus(sentence_file, tag_file=None):
+    """Parses the CSV files of load_data, splitting the documents at '-DOCSTART-'.
+
+    Returns:
+        tuple: the sentences, and the tags when tag_file is given
+    """
+    df_sentences = pd.read_csv(open(sentence_file), dtype={'word': str})
+    words, is_doc_start = normalize_words(df_sentences['word'])
+
+    # Documents run from one '-DOCSTART-' to the next, rows before the first one are dropped
+    doc_start_indexes = np.flatnonzero(is_doc_start)
+    if len(doc_start_indexes) == 0:
+        return ([], []) if tag_file else ([],)
+    first, split_indexes = doc_start_indexes[0], doc_start_indexes[1:] - doc_start_indexes[0]
+    stop = ['<STOP>'] if STOP_WORD else []
+
+    sentences = [doc.tolist() + stop for doc in np.split(words[first:], split_indexes)]
     if tag_file:
+        df_tags = pd.read_csv(open(tag_file), dtype={'tag': str})
+        tag_column = df_tags['tag'].to_numpy(dtype=object)[first:len(words)]
+        tags = [doc.tolist() + stop for doc in np.split(tag_column, split_indexes)]
         return sentences, tags
 
-    return sentences
+    return (sentences,)
+
+
+def iter_data(sentence_file, tag_file=None, chunksize=100000):
+    """Yields the documents of load_data one at a time, reading the files chunksize rows at a time.
+
+    Memory use depends on chunksize and on the longest document, not on the size of the files.
+
+    Yields:
+        list[str]: a sentence, or a (sentence, tags) pair when tag_file is given
+    """
+    # Without dtype, a chunk whose words are all numbers would be read as a numeric column
+    word_chunks = pd.read_csv(sentence_file, chunksize=chunksize, dtype={'word': str})
+    tag_chunks = pd.read_csv(tag_file, chunksize=chunksize, dtype={'tag': str}) if tag_file else itertools.repeat(None)
+    stop = ['<STOP>'] if STOP_WORD else []
+    sent, tag = None, None  # rows before the first '-DOCSTART-' are dropped
+    for df_sentences, df_tags in zip(word_chunks, tag_chunks):
+        words, is_doc_start = normalize_words(df_sentences['word'])
+        tag_column = df_tags['tag'].to_numpy(dtype=object) if tag_file else None
+        start = 0
+        for end in np.append(np.flatnonzero(is_doc_start), len(words)):
+            if sent is not None:
+                sent.extend(words[start:end].tolist())
+                if tag_file:
+                    tag.extend(tag_column[start:end].tolist())
+            if end < len(words):
+                # a new document starts at this row
+                if sent is not None:
+                    yield (sent + stop, tag + stop) if tag_file else sent + stop
+                sent, tag = [], []
+            start = end
+    if sent is not None:
+        yield (sent + stop, tag + stop) if tag_file else sent + stop
+
+
+def write_predictions(file, predictions):
+    """Writes predicted tags as 'id,tag' CSV rows, numbering the tokens of all documents consecutively.
+
+    predictions can be a generator, each document is written as soon as it is produced.
+
+    Args:
+        file (str): output path, e.g. 'test_y.csv'
+        predictions (iterable[list[str]]): the predicted tags of every document
+
+    Returns:
+        int: the number of rows written
+    """
+    n_rows = 0
+    with open(file, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['id', 'tag'])
+        for tags in predictions:
+            writer.writerows(zip(range(n_rows, n_rows + len(tags)), tags))
+            n_rows += len(tags)
+    return n_rows
+
+
+class Corpus():
+    """Documents stored as flat int32 word and tag id arrays plus document offsets, like a CSR matrix.
+
+    Document i is word_vocab[word_ids[offsets[i]:offsets[i+1]]], and likewise for the tags of a tagged
+    corpus. Indexing with an integer returns one document in the format of iter_data, indexing with a
+    slice or an array of document numbers returns a Corpus that shares the vocabularies.
+    """
+    def __init__(self, word_ids, word_vocab, offsets, tag_ids=None, tag_vocab=None):
+        self.word_ids = word_ids
+        self.word_vocab = word_vocab
+        self.offsets = offsets
+        self.tag_ids = tag_ids
+        self.tag_vocab = tag_vocab
+
+    @classmethod
+    def from_lists(cls, sentences, tags=None):
+        """Encodes documents given as lists of strings, e.g. the output of load_data."""
+        word_ids, word_vocab, offsets = factorize_sequences(sentences)
+        if tags is None:
+            return cls(word_ids.astype(np.int32), word_vocab, offsets)
+        tag_ids, tag_vocab, _ = factorize_sequences(tags)
+        return cls(word_ids.astype(np.int32), word_vocab, offsets, tag_ids.astype(np.int32), tag_vocab)
+
+    @classmethod
+    def load(cls, sentence_file, tag_file=None):
+        """Loads a corpus like load_data, memory-mapping the ids from CORPUS_CACHE when it is set."""
+        names = ['word', 'tag'] if tag_file else ['word']
+        data = None
+        if CORPUS_CACHE is not None:
+            cache_dir = corpus_cache_path([sentence_file, tag_file] if tag_file else [sentence_file])
+            if not os.path.isdir(cache_dir):
+                data = load_data(sentence_file, tag_file)  # parses the files and writes the cache
+            if os.path.isdir(cache_dir):
+                corpus = read_corpus_cache(cache_dir, names)
+                vocabs = [np.array(corpus[f'{name}_vocab'], dtype=object) for name in names]
+                if tag_file:
+                    return cls(corpus['word_ids'], vocabs[0], corpus['offsets'], corpus['tag_ids'], vocabs[1])
+                return cls(corpus['word_ids'], vocabs[0], corpus['offsets'])
+        if data is None:
+            data = load_data(sentence_file, tag_file)
+        return cls.from_lists(*data) if tag_file else cls.from_lists(data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            i = range(len(self))[key]
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            sentence = self.word_vocab[self.word_ids[start:stop]].tolist()
+            if self.tag_ids is None:
+                return sentence
+            return sentence, self.tag_vocab[self.tag_ids[start:stop]].tolist()
+
+        docs = np.arange(len(self))[key]
+        lengths = np.diff(self.offsets)[docs]
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if isinstance(key, slice) and (key.step is None or key.step == 1):
+            # Contiguous documents are views of the same arrays
+            token_index = slice(self.offsets[docs[0]], self.offsets[docs[0]] + offsets[-1]) if len(docs) else slice(0, 0)
+        else:
+            token_index = np.repeat(self.offsets[docs] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        tag_ids = None if self.tag_ids is None else self.tag_ids[token_index]
+        return Corpus(self.word_ids[token_index], self.word_vocab, offsets, tag_ids, self.tag_vocab)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_lists(self):
+        """Returns the documents in the format of load_data."""
+        sentences = decode_sequences(self.word_ids, self.word_vocab, self.offsets)
+        if self.tag_ids is None:
+            return sentences
+        return sentences, decode_sequences(self.tag_ids, self.tag_vocab, self.offsets)
 
 
 def confusion_matrix(tag2idx,idx2tag, pred, gt, fname):